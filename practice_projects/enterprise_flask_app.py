@@ -3,19 +3,50 @@ Flask Web开发进阶示例 - 外企面试项目
 包含认证、缓存、限流、错误处理等企业级特性
 """
 
-from flask import Flask, request, jsonify, g
+from flask import Flask, request, jsonify, g, has_request_context, copy_current_request_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 from flask_migrate import Migrate
-from werkzeug.security import generate_password_hash, check_password_hash
+import click
+from sqlalchemy import event, inspect, bindparam, tuple_, text, create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
 from functools import wraps
 import jwt
 import redis
 import time
+import math
 import logging
 from datetime import datetime, timedelta
 import json
-from collections import defaultdict
+import sys
+import hashlib
+import random
+import pickle
+import zlib
+from collections import defaultdict, OrderedDict
+from itertools import islice
 import threading
+import atexit
+import bisect
+import uuid
+import fnmatch
+import base64
+import re
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 # ====================== 1. 应用配置 ======================
@@ -23,11 +54,81 @@ import threading
 class Config:
     """应用配置类"""
     SECRET_KEY = 'your-secret-key-here'
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///enterprise_app.db'
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'sqlite:///enterprise_app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # 连接池：浏览量回写、登录时间更新和读请求共用。启动时按每个数据库URL生成引擎参数，
+    # 内存SQLite（使用StaticPool）不设置连接池大小，见configure_engine_options()
+    SQLALCHEMY_POOL_OPTIONS = {
+        'pool_size': 10,
+        'max_overflow': 10,
+        'pool_timeout': 10,
+        'pool_recycle': 3600,
+    }
+    # 只读副本：配置 SQLALCHEMY_BINDS = {'replica': 'sqlite:///replica.db'}（或设置REPLICA_DATABASE_URL）后，
+    # @read_only视图的查询发往副本；客户端提交写入后这么多秒内仍读主库（读己之写）
+    SQLALCHEMY_BINDS = {'replica': os.environ['REPLICA_DATABASE_URL']} if os.environ.get('REPLICA_DATABASE_URL') else {}
+    REPLICA_STICKY_SECONDS = 5
+    # SQLite连接参数：每个新连接执行的PRAGMA，按名称选择
+    SQLITE_PROFILE = 'production'
+    SQLITE_PROFILES = {
+        'default': {},
+        'production': {
+            'journal_mode': 'WAL',          # 读写互不阻塞
+            'synchronous': 'NORMAL',        # WAL下只在检查点fsync，断电最多丢失最近的事务
+            'busy_timeout': 5000,           # 等待写锁的毫秒数，而不是立即报database is locked
+            'mmap_size': 256 * 1024 * 1024,
+            'cache_size': -64000,           # 负数单位为KiB
+            'temp_store': 'MEMORY',
+        },
+    }
     JWT_EXPIRATION_DELTA = timedelta(hours=24)
     REDIS_URL = 'redis://localhost:6379/0'
     RATE_LIMIT_STORAGE_URL = 'redis://localhost:6379/1'
+    # 限流算法：sliding_window（精确，O(limit)内存）或 gcra（O(1)内存）
+    RATE_LIMIT_ALGORITHM = 'sliding_window'
+    # 内存限流存储的分片数和过期键清理间隔(秒)
+    RATE_LIMIT_SHARDS = 16
+    RATE_LIMIT_SWEEP_INTERVAL = 60
+    # 近似限流：每个worker本地计数，累计到limit×该比例后再同步Redis；None表示每个请求都访问Redis
+    RATE_LIMIT_SYNC_FRACTION = None
+    # 认证用户快照缓存秒数（用户信息变更时立即失效）
+    AUTH_CACHE_TTL = 60
+    # 无状态认证：令牌中签入is_admin/is_active和令牌版本，认证时不查询用户
+    JWT_CLAIMS_MODE = False
+    # 密码哈希：None使用werkzeug默认算法（scrypt）且登录时不重算；显式设置时
+    # （可用calibrate_password_hash_cost()按目标耗时选择）登录时把更弱的旧哈希升级到该配置，
+    # 从不由scrypt降为pbkdf2。专用线程数、排队上限和等待超时(秒)
+    PASSWORD_HASH_METHOD = None
+    PASSWORD_HASH_WORKERS = 2
+    PASSWORD_HASH_QUEUE = 16
+    PASSWORD_HASH_TIMEOUT = 10
+    # /metrics中数据库计数的缓存秒数
+    METRICS_CACHE_TTL = 15
+    # 多进程部署时各worker写入指标快照的目录（None表示单进程），以及写入间隔(秒)
+    METRICS_MULTIPROC_DIR = None
+    METRICS_DUMP_INTERVAL = 5
+    # 浏览量缓冲写回数据库的间隔(秒)
+    VIEW_COUNT_FLUSH_INTERVAL = 5
+    # 进程内缓存上限（Redis不可用时使用）
+    CACHE_MAX_ENTRIES = 10000
+    CACHE_MAX_BYTES = 64 * 1024 * 1024
+    # L1本地缓存（Redis可用时位于Redis之前）
+    CACHE_L1_MAX_ENTRIES = 1000
+    CACHE_L1_TTL = 5
+    # 缓存重建锁（防止缓存击穿）
+    CACHE_LOCK_TIMEOUT = 10
+    CACHE_LOCK_WAIT = 5
+    # 命名空间代数在本地缓存的秒数（跨worker失效的最大延迟）
+    CACHE_GENERATION_TTL = 1
+    # stale-while-revalidate后台刷新线程池
+    CACHE_REFRESH_WORKERS = 4
+    CACHE_REFRESH_QUEUE = 64
+    # 缓存序列化：默认编解码器、按命名空间覆盖
+    CACHE_SERIALIZER = 'json'
+    # pickle.loads会执行任意代码，只在Redis完全可信时按命名空间启用，例如 {'posts': 'pickle'}
+    CACHE_NAMESPACE_SERIALIZERS = {}
+    # 超过阈值(字节)时zlib压缩，None表示不压缩；压缩以CPU换取Redis内存和带宽，参见benchmark_serializers()
+    CACHE_COMPRESS_THRESHOLD = None
 
 
 # ====================== 2. 应用初始化 ======================
@@ -35,10 +136,81 @@ class Config:
 app = Flask(__name__)
 app.config.from_object(Config)
 
+
+def engine_options_for(uri, pool_options):
+    """按数据库URL生成引擎参数：内存SQLite只有一个共享连接，不接受连接池大小参数"""
+    url = make_url(uri)
+    in_memory = url.database in (None, '', ':memory:') or url.query.get('mode') == 'memory'
+    if url.get_backend_name() == 'sqlite' and in_memory:
+        return {}
+    return dict(pool_options)
+
+
+def configure_engine_options():
+    """在创建引擎之前为主库和每个绑定填入连接池参数（显式配置的参数优先）"""
+    pool_options = app.config['SQLALCHEMY_POOL_OPTIONS']
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        **engine_options_for(app.config['SQLALCHEMY_DATABASE_URI'], pool_options),
+        **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})
+    }
+    app.config['SQLALCHEMY_BINDS'] = {
+        key: bind if isinstance(bind, dict) else {'url': bind, **engine_options_for(bind, pool_options)}
+        for key, bind in app.config.get('SQLALCHEMY_BINDS', {}).items()
+    }
+
+
+configure_engine_options()
+
 # 数据库
-db = SQLAlchemy(app)
+REPLICA_BIND_KEY = 'replica'
+
+
+class RoutingSession(Session):
+    """
+    读写分离会话 - @read_only视图中的查询发往replica绑定，其余走主库
+    
+    没有配置replica绑定时与默认会话相同。flush、INSERT/UPDATE/DELETE语句、
+    以及刚提交过写入的客户端（见mark_replica_sticky）始终使用主库。
+    """
+    
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing
+                and not getattr(clause, 'is_dml', False)
+                and REPLICA_BIND_KEY in self._db.engines
+                and should_read_replica()):
+            return self._db.engines[REPLICA_BIND_KEY]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
 migrate = Migrate(app, db)
 
+
+def sqlite_pragma_listener(pragmas):
+    """返回connect事件处理函数：在每个新的SQLite连接上执行PRAGMA"""
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+        finally:
+            cursor.close()
+    return on_connect
+
+
+def configure_sqlite_engines():
+    """给所有SQLite引擎挂上当前配置档的PRAGMA"""
+    pragmas = app.config['SQLITE_PROFILES'][app.config['SQLITE_PROFILE']]
+    if not pragmas:
+        return
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'sqlite':
+                event.listen(engine, 'connect', sqlite_pragma_listener(pragmas))
+
+
+configure_sqlite_engines()
+
 # Redis缓存
 try:
     redis_client = redis.from_url(app.config['REDIS_URL'])
@@ -57,8 +229,115 @@ logger = logging.getLogger(__name__)
 
 # ====================== 3. 数据模型 ======================
 
+class HashingBusyError(Exception):
+    """密码哈希线程池已满"""
+    pass
+
+
+class PasswordHasher:
+    """
+    密码哈希线程池
+    
+    scrypt/PBKDF2计算放到专用的有界线程池中执行（hashlib计算时会释放GIL），
+    同时进行的哈希数量不超过workers，登录高峰时不会占满所有请求线程的CPU；
+    排队数量超过max_pending时直接抛出HashingBusyError，由调用方快速返回503。
+    method为None时使用werkzeug的默认算法，needs_rehash()始终返回False。
+    """
+    
+    # 算法强度顺序：只会向更强的算法迁移
+    ALGORITHM_RANK = {'pbkdf2': 0, 'scrypt': 1}
+    
+    def __init__(self, method=None, workers=2, max_pending=16, timeout=10):
+        self.method = method
+        self.method_params = self.expand_method(method) if method else None
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        self._slots = threading.BoundedSemaphore(max_pending)
+    
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusyError()
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise HashingBusyError()
+    
+    @staticmethod
+    def expand_method(method):
+        """
+        按werkzeug的规则把方法简写展开为存储在哈希中的完整参数，
+        例如'scrypt' -> ['scrypt', '32768', '8', '1']，'pbkdf2' -> ['pbkdf2', 'sha256', '1000000']
+        """
+        parts = method.split(':')
+        if parts[0] == 'scrypt':
+            defaults = ['scrypt', str(2 ** 15), '8', '1']
+        elif parts[0] == 'pbkdf2':
+            defaults = ['pbkdf2', 'sha256', str(DEFAULT_PBKDF2_ITERATIONS)]
+        else:
+            return parts
+        return parts + defaults[len(parts):]
+    
+    def hash(self, password):
+        """计算密码哈希"""
+        if self.method is None:
+            return self._run(generate_password_hash, password)
+        return self._run(generate_password_hash, password, self.method)
+    
+    def verify(self, password_hash, password):
+        """验证密码"""
+        return self._run(check_password_hash, password_hash, password)
+    
+    def needs_rehash(self, password_hash):
+        """存储的哈希比显式配置的方法更弱时需要重新计算（只升级，不降级）"""
+        if self.method_params is None:
+            return False
+        
+        stored = password_hash.split('$', 1)[0].split(':')
+        target = self.method_params
+        if stored == target:
+            return False
+        
+        stored_rank = self.ALGORITHM_RANK.get(stored[0])
+        target_rank = self.ALGORITHM_RANK.get(target[0])
+        if stored_rank is None or target_rank is None:
+            return False
+        if stored_rank != target_rank:
+            return target_rank > stored_rank
+        
+        try:
+            if target[0] == 'pbkdf2':
+                # 摘要算法不同时按配置重算，否则只在迭代次数提高时重算
+                return target[1] != stored[1] or int(target[2]) > int(stored[2])
+            # scrypt: 计算量与 N*r*p 成正比
+            return math.prod(map(int, target[1:])) > math.prod(map(int, stored[1:]))
+        except (IndexError, ValueError):
+            return False
+
+
+password_hasher = PasswordHasher(
+    method=app.config['PASSWORD_HASH_METHOD'],
+    workers=app.config['PASSWORD_HASH_WORKERS'],
+    max_pending=app.config['PASSWORD_HASH_QUEUE'],
+    timeout=app.config['PASSWORD_HASH_TIMEOUT']
+)
+
+
 class User(db.Model):
     """用户模型"""
+    __table_args__ = (
+        # 管理后台按注册时间倒序分页
+        db.Index('ix_user_created_at_id', 'created_at', 'id'),
+        # SQLite默认会复用已删除的最大id，新用户会继承被删用户的令牌和吊销记录
+        {'sqlite_autoincrement': True},
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
@@ -67,17 +346,19 @@ class User(db.Model):
     is_admin = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_login = db.Column(db.DateTime)
+    # 令牌版本：禁用或角色变更时递增，旧版本令牌随之失效
+    token_version = db.Column(db.Integer, default=0, nullable=False)
     
     # 关系
     posts = db.relationship('Post', backref='author', lazy=True, cascade='all, delete-orphan')
     
     def set_password(self, password):
         """设置密码哈希"""
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
     
     def check_password(self, password):
         """验证密码"""
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.verify(self.password_hash, password)
     
     def generate_token(self):
         """生成JWT令牌"""
@@ -86,19 +367,32 @@ class User(db.Model):
             'username': self.username,
             'exp': datetime.utcnow() + app.config['JWT_EXPIRATION_DELTA']
         }
+        if app.config['JWT_CLAIMS_MODE']:
+            payload.update({
+                'is_admin': self.is_admin,
+                'is_active': self.is_active,
+                'ver': self.token_version or 0
+            })
         return jwt.encode(payload, app.config['SECRET_KEY'], algorithm='HS256')
     
     @staticmethod
-    def verify_token(token):
-        """验证JWT令牌"""
+    def decode_token(token):
+        """解码并校验JWT令牌，返回payload，无效时返回None"""
         try:
-            payload = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
-            return User.query.get(payload['user_id'])
+            return jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
         except jwt.ExpiredSignatureError:
             return None
         except jwt.InvalidTokenError:
             return None
     
+    @staticmethod
+    def verify_token(token):
+        """验证JWT令牌"""
+        payload = User.decode_token(token)
+        if payload is None:
+            return None
+        return User.query.get(payload['user_id'])
+    
     def to_dict(self):
         """转换为字典"""
         return {
@@ -112,8 +406,40 @@ class User(db.Model):
         }
 
 
+class UserSnapshot:
+    """用户行快照 - 认证缓存中保存的只读用户信息，属性和to_dict()与User一致"""
+    __slots__ = ('id', 'username', 'email', 'is_active', 'is_admin', 'created_at', 'last_login')
+    
+    def __init__(self, data):
+        for name in self.__slots__:
+            setattr(self, name, data[name])
+    
+    def to_dict(self):
+        """转换为字典"""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class ClaimsPrincipal:
+    """由令牌声明构造的用户身份 - 只包含授权所需的字段，不访问数据库"""
+    __slots__ = ('id', 'username', 'is_active', 'is_admin', 'token_version')
+    
+    def __init__(self, payload):
+        self.id = payload['user_id']
+        self.username = payload['username']
+        self.is_active = payload['is_active']
+        self.is_admin = payload['is_admin']
+        self.token_version = payload['ver']
+
+
 class Post(db.Model):
     """文章模型"""
+    __table_args__ = (
+        # 已发布文章列表：WHERE published ORDER BY created_at DESC, id DESC
+        db.Index('ix_post_published_created_at_id', 'published', 'created_at', 'id'),
+        # 某个作者的文章按时间排序
+        db.Index('ix_post_user_id_created_at', 'user_id', 'created_at'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
     content = db.Column(db.Text, nullable=False)
@@ -139,116 +465,1610 @@ class Post(db.Model):
         }
 
 
-# ====================== 4. 缓存系统 ======================
+class QueryCounter:
+    """
+    SQL查询计数器 - 统计代码块内执行的SQL语句数，用于发现N+1查询
+    
+        with app.app_context(), QueryCounter(max_queries=3):
+            client.get('/api/posts')
+    
+    超过max_queries时在退出代码块时抛出AssertionError并列出所有语句。
+    统计的是所有引擎（包括只读副本）上所有线程执行的语句，需要在应用上下文中使用。
+    """
+    
+    def __init__(self, max_queries=None):
+        self.max_queries = max_queries
+        self.count = 0
+        self.statements = []
+        self._engines = []
+    
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+        self.statements.append(statement)
+    
+    def __enter__(self):
+        self._engines = list(db.engines.values())
+        for engine in self._engines:
+            event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for engine in self._engines:
+            event.remove(engine, 'before_cursor_execute', self._before_cursor_execute)
+        if exc_type is None and self.max_queries is not None and self.count > self.max_queries:
+            raise AssertionError(
+                f"执行了{self.count}条SQL，超过上限{self.max_queries}:\n" + "\n".join(self.statements)
+            )
+        return False
+
+
+class InvalidCursorError(ValueError):
+    """分页游标无法解析"""
+    pass
+
+
+def _encode_token(value):
+    raw = json.dumps(value, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+def _decode_token(token):
+    try:
+        return json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except ValueError as e:
+        raise InvalidCursorError(f"无效的分页游标: {token}") from e
+
+
+def encode_cursor(created_at, row_id):
+    """把排序键(created_at, id)编码为不透明的URL安全游标"""
+    return _encode_token([created_at.isoformat(), row_id])
+
+
+def decode_cursor(cursor):
+    """解析游标，返回(created_at, id)"""
+    value = _decode_token(cursor)
+    try:
+        created_at, row_id = value
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, TypeError) as e:
+        raise InvalidCursorError(f"无效的分页游标: {cursor}") from e
+
+
+def keyset_paginate(query, model, per_page, after=None, before=None):
+    """
+    键集（游标）分页 - 按(created_at, id)倒序
+    
+    用 WHERE (created_at, id) < (?, ?) 代替 OFFSET，配合索引任何深度的页
+    开销都相同；多取一行判断是否还有下一页，不执行COUNT(*)。
+    before用于向前翻页：按正序取再反转。
+    
+    返回 (rows, pagination)，pagination包含next_cursor/prev_cursor/has_more。
+    """
+    sort_key = tuple_(model.created_at, model.id)
+    
+    if before:
+        query = query.filter(sort_key > decode_cursor(before)).order_by(
+            model.created_at.asc(), model.id.asc()
+        )
+    else:
+        if after:
+            query = query.filter(sort_key < decode_cursor(after))
+        query = query.order_by(model.created_at.desc(), model.id.desc())
+    
+    rows = query.limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if before:
+        rows.reverse()
+    
+    # 向前翻页时游标所在的行之后必然还有数据
+    has_next = has_more if not before else True
+    has_prev = bool(after) or (bool(before) and has_more)
+    
+    return rows, {
+        'per_page': per_page,
+        'has_more': has_next,
+        'next_cursor': encode_cursor(rows[-1].created_at, rows[-1].id) if rows and has_next else None,
+        'prev_cursor': encode_cursor(rows[0].created_at, rows[0].id) if rows and has_prev else None,
+    }
+
+
+class PostSearch:
+    """
+    文章全文搜索 - SQLite FTS5外部内容表
+    
+    post_fts只保存倒排索引，正文仍在post表；由触发器在增删改时同步，
+    更新只在title/content变化时触发，浏览量回写不会重建索引。查询按bm25排序（标题权重更高）。
+    
+    优先使用trigram分词器（SQLite >= 3.34）：按子串匹配，中文不需要分词，
+    但每个词至少3个字符。旧版本SQLite使用unicode61按词前缀匹配，无法切分中文。
+    match_expression()返回空串（词太短、或unicode61遇到中文）时调用方回退到LIKE，
+    数据库不是SQLite或未编译FTS5时available()返回False，同样回退到LIKE。
+    """
+    
+    TITLE_WEIGHT = 10.0
+    CONTENT_WEIGHT = 1.0
+    MAX_TERMS = 8
+    TOKENIZERS = ('trigram', 'unicode61 remove_diacritics 2')
+    CJK_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]')
+    
+    TABLE = (
+        "CREATE VIRTUAL TABLE post_fts USING fts5("
+        "title, content, content='post', content_rowid='id', tokenize='{tokenizer}')"
+    )
+    TRIGGERS = [
+        "CREATE TRIGGER IF NOT EXISTS post_fts_ai AFTER INSERT ON post BEGIN "
+        "INSERT INTO post_fts(rowid, title, content) VALUES (new.id, new.title, new.content); END",
+        "CREATE TRIGGER IF NOT EXISTS post_fts_ad AFTER DELETE ON post BEGIN "
+        "INSERT INTO post_fts(post_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content); END",
+        "CREATE TRIGGER IF NOT EXISTS post_fts_au AFTER UPDATE OF title, content ON post BEGIN "
+        "INSERT INTO post_fts(post_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content); "
+        "INSERT INTO post_fts(rowid, title, content) VALUES (new.id, new.title, new.content); END",
+    ]
+    
+    def __init__(self):
+        self._available = None
+        self._tokenizer = None
+    
+    def ensure_index(self):
+        """
+        创建FTS表和触发器并从post表重建索引（需要应用上下文）
+        
+        已有的表使用的分词器不是首选时（例如SQLite升级后支持了trigram）删除重建。
+        """
+        if db.engine.dialect.name != 'sqlite':
+            self._available = False
+            return False
+        
+        current = self._current_tokenizer()
+        for tokenizer in self.TOKENIZERS:
+            if current == tokenizer:
+                break
+            try:
+                if current is not None:
+                    db.session.execute(text("DROP TABLE post_fts"))
+                db.session.execute(text(self.TABLE.format(tokenizer=tokenizer)))
+                db.session.execute(text("INSERT INTO post_fts(post_fts) VALUES ('rebuild')"))
+                db.session.commit()
+                current = tokenizer
+                break
+            except Exception as e:
+                db.session.rollback()
+                logger.warning(f"无法使用FTS5分词器{tokenizer}: {e}")
+        
+        if current is None:
+            logger.warning("FTS5不可用，搜索将使用LIKE")
+            self._available = False
+            return False
+        
+        for statement in self.TRIGGERS:
+            db.session.execute(text(statement))
+        db.session.commit()
+        self._tokenizer = current
+        self._available = True
+        return True
+    
+    def _current_tokenizer(self):
+        """已有post_fts表使用的分词器，表不存在时返回None"""
+        row = db.session.execute(
+            text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'post_fts'")
+        ).first()
+        if row is None:
+            return None
+        match = re.search(r"tokenize\s*=\s*'([^']*)'", row[0])
+        return match.group(1) if match else 'unicode61'
+    
+    def available(self):
+        """索引是否可用（其他进程可能已经建好，首次调用时检查一次）"""
+        if self._available is None:
+            self._tokenizer = self._current_tokenizer() if db.engine.dialect.name == 'sqlite' else None
+            self._available = self._tokenizer is not None
+        return self._available
+    
+    def match_expression(self, search):
+        """
+        把用户输入转换为FTS5查询：每个词加引号去掉所有运算符，多个词取交集
+        
+        trigram按子串匹配，短于3个字符的词无法使用索引；unicode61按词前缀匹配，
+        不能切分中文。这两种情况返回空串，由调用方回退到LIKE。
+        """
+        terms = re.findall(r'\w+', search)[:self.MAX_TERMS]
+        if self._tokenizer == 'trigram':
+            if any(len(term) < 3 for term in terms):
+                return ''
+            return ' '.join(f'"{term}"' for term in terms)
+        
+        if self.CJK_PATTERN.search(search):
+            return ''
+        return ' '.join(f'"{term}"*' for term in terms)
+    
+    def search(self, search, limit, offset=0):
+        """返回按相关度排序的已发布文章ID列表；需要回退到LIKE时返回None"""
+        match = self.match_expression(search)
+        if not match:
+            return None
+        
+        rows = db.session.execute(text(
+            "SELECT post.id FROM post_fts JOIN post ON post.id = post_fts.rowid "
+            "WHERE post_fts MATCH :match AND post.published = 1 "
+            "ORDER BY bm25(post_fts, :title_weight, :content_weight) "
+            "LIMIT :limit OFFSET :offset"
+        ), {
+            'match': match,
+            'title_weight': self.TITLE_WEIGHT,
+            'content_weight': self.CONTENT_WEIGHT,
+            'limit': limit,
+            'offset': offset
+        })
+        return [row[0] for row in rows]
+
+
+post_search = PostSearch()
+
+
+# ====================== 4. 缓存系统 ======================
+
+class LocalCache:
+    """进程内缓存引擎 - 支持TTL、条目数/字节数上限和O(1) LRU淘汰"""
+    
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024, default_ttl=3600):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._data = OrderedDict()  # key -> (value, expire_at, size)，按访问顺序排列
+        self._bytes = 0
+        self._lock = threading.Lock()
+        
+        # 统计计数器
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    # 估算容器大小时每层最多抽样的元素数
+    SIZE_SAMPLE = 8
+    
+    @classmethod
+    def _estimate_size(cls, value):
+        """
+        估算值占用的字节数
+        
+        字符串按长度计；容器只递归抽样前SIZE_SAMPLE个元素，按平均值外推到全部元素，
+        开销与值的大小无关（对整个值做json.dumps，100篇文章的列表每次约需0.5毫秒）。
+        """
+        if isinstance(value, (bytes, bytearray, str)):
+            return len(value)
+        if isinstance(value, dict):
+            sample = list(islice(value.items(), cls.SIZE_SAMPLE))
+            sampled = sum(cls._estimate_size(k) + cls._estimate_size(v) for k, v in sample)
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            sample = list(islice(value, cls.SIZE_SAMPLE))
+            sampled = sum(cls._estimate_size(item) for item in sample)
+        else:
+            return sys.getsizeof(value)
+        if not sample:
+            return sys.getsizeof(value)
+        return sys.getsizeof(value) + sampled * len(value) // len(sample)
+    
+    def _remove(self, key):
+        """删除条目并更新字节数（调用方需持有锁）"""
+        _, _, size = self._data.pop(key)
+        self._bytes -= size
+    
+    def get(self, key, default=None):
+        """获取缓存，命中时移动到LRU队尾"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            
+            if entry[1] <= now:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def set(self, key, value, ttl=None, size=None):
+        """设置缓存，超出上限时淘汰最久未使用的条目；size未给出时自动估算"""
+        if size is None:
+            size = self._estimate_size(value)
+        expire_at = time.monotonic() + (self.default_ttl if ttl is None else ttl)
+        
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            
+            # 单个值超过字节上限时不缓存
+            if size > self.max_bytes:
+                return False
+            
+            self._data[key] = (value, expire_at, size)
+            self._bytes += size
+            
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+                self.evictions += 1
+        
+        return True
+    
+    def delete(self, key):
+        """删除缓存"""
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+                return True
+            return False
+    
+    def keys(self):
+        """返回当前所有键的快照"""
+        with self._lock:
+            return list(self._data.keys())
+    
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def stats(self):
+        """缓存统计信息"""
+        with self._lock:
+            return {
+                'entries': len(self._data),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
+
+
+class JsonSerializer:
+    """JSON编解码器 - 可读性好，跨语言"""
+    name = 'json'
+    
+    def dumps(self, value):
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+    
+    def loads(self, data):
+        return json.loads(data)
+
+
+class PickleSerializer:
+    """pickle二进制编解码器 - 速度快，支持bytes/datetime等类型，只能用于可信的缓存数据"""
+    name = 'pickle'
+    
+    def dumps(self, value):
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class MsgpackSerializer:
+    """msgpack二进制编解码器 - 体积小，跨语言（需要安装msgpack）"""
+    name = 'msgpack'
+    
+    def dumps(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+    
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+class CompressedSerializer:
+    """
+    压缩包装器 - 序列化结果超过阈值时使用zlib压缩
+    
+    输出首字节为标记：0表示未压缩，1表示zlib压缩
+    """
+    RAW = b'\x00'
+    ZLIB = b'\x01'
+    
+    def __init__(self, serializer, threshold=1024, level=1):
+        self.serializer = serializer
+        self.threshold = threshold
+        self.level = level
+        self.name = f"{serializer.name}+zlib"
+    
+    def dumps(self, value):
+        data = self.serializer.dumps(value)
+        if len(data) >= self.threshold:
+            return self.ZLIB + zlib.compress(data, self.level)
+        return self.RAW + data
+    
+    def loads(self, data):
+        if data[:1] == self.ZLIB:
+            return self.serializer.loads(zlib.decompress(data[1:]))
+        return self.serializer.loads(data[1:])
+
+
+SERIALIZERS = {
+    'json': JsonSerializer,
+    'pickle': PickleSerializer,
+    'msgpack': MsgpackSerializer,
+}
+
+
+def make_serializer(name, compress_threshold=None):
+    """按名称创建编解码器，compress_threshold不为None时启用压缩"""
+    if name not in SERIALIZERS:
+        raise ValueError(f"未知的序列化器: {name}")
+    if name == 'msgpack' and msgpack is None:
+        # 不能退回pickle：那会在共享的Redis数据上执行pickle.loads
+        logger.warning("msgpack未安装，使用json代替")
+        name = 'json'
+    
+    serializer = SERIALIZERS[name]()
+    if compress_threshold is not None:
+        serializer = CompressedSerializer(serializer, compress_threshold)
+    return serializer
+
+
+class SingleFlight:
+    """请求合并 - 同一个键同时只有一个调用方执行加载函数，其余调用方等待其结果"""
+    
+    class _Call:
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+    
+    def do(self, key, fn):
+        """执行fn()，同一键的并发调用共享同一次执行的结果"""
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = self._Call()
+        
+        if not is_leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+
+class CacheManager:
+    """
+    两级缓存管理器
+    
+    L1: 进程内LocalCache，保存已反序列化的对象，TTL较短
+    L2: Redis，多个worker共享
+    读取时L1未命中则回源L2并提升到L1，写入时同时写两级（write-through）。
+    Redis不可用时只有L1一级，容量和TTL按完整缓存配置。
+    
+    批量失效使用命名空间代数：键中带有命名空间当前代数，
+    invalidate_namespace()递增代数后旧键不再被访问，随TTL/LRU自然淘汰。
+    
+    get_or_refresh()支持软/硬两级TTL：软TTL过期后仍返回旧值并在后台刷新，
+    硬TTL过期后才同步回源。
+    
+    L2的编解码器按键的命名空间（第一个冒号前的部分）选择，未配置的命名空间使用默认编解码器。
+    注意：L1返回的是共享对象，调用方不应修改。
+    """
+    
+    # 只有持有者才能释放锁（比较token后删除）
+    RELEASE_LOCK_SCRIPT = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+    """
+    
+    def __init__(self, redis_client=None, max_entries=10000, max_bytes=64 * 1024 * 1024,
+                 l1_max_entries=1000, l1_ttl=5, lock_timeout=10, lock_wait=5, generation_ttl=1,
+                 refresh_workers=4, refresh_queue=64, serializer=None, namespace_serializers=None):
+        self.redis = redis_client
+        self.serializer = serializer or JsonSerializer()
+        self.namespace_serializers = namespace_serializers or {}
+        self.l1_ttl = l1_ttl
+        self.lock_timeout = lock_timeout
+        self.lock_wait = lock_wait
+        self._flight = SingleFlight()
+        self._release_lock = redis_client.register_script(self.RELEASE_LOCK_SCRIPT) if redis_client else None
+        
+        # 命名空间代数：有Redis时以Redis为准并在本地短暂缓存，否则保存在进程内
+        self._generations = {}
+        self._generation_lock = threading.Lock()
+        self._generation_cache = LocalCache(max_entries=1024, default_ttl=generation_ttl)
+        
+        # 后台刷新：有界线程池，同一键同时只排队一次
+        self._refresh_executor = ThreadPoolExecutor(max_workers=refresh_workers,
+                                                    thread_name_prefix='cache-refresh')
+        self._refresh_queue = refresh_queue
+        self._refreshing = set()
+        self._refresh_lock = threading.Lock()
+        if redis_client:
+            self.memory_cache = LocalCache(l1_max_entries, max_bytes, default_ttl=l1_ttl)
+        else:
+            self.memory_cache = LocalCache(max_entries, max_bytes)
+        
+        self._stats_lock = threading.Lock()
+        self.l2_hits = 0
+        self.l2_misses = 0
+    
+    def _local_ttl(self, expire):
+        """L1中条目的TTL：有L2时不超过l1_ttl"""
+        return min(expire, self.l1_ttl) if self.redis else expire
+    
+    def _record_l2(self, hit):
+        with self._stats_lock:
+            if hit:
+                self.l2_hits += 1
+            else:
+                self.l2_misses += 1
+    
+    def get(self, key):
+        """获取缓存：先查L1，未命中再查L2并提升到L1"""
+        value = self.memory_cache.get(key)
+        if value is not None or not self.redis:
+            return value
+        
+        try:
+            raw = self.redis.get(key)
+            value = self.serializer_for(key).loads(raw) if raw else None
+        except:
+            return None
+        
+        self._record_l2(value is not None)
+        if value is not None:
+            self.memory_cache.set(key, value, self.l1_ttl, size=len(raw))
+        return value
+    
+    def set(self, key, value, expire=3600):
+        """设置缓存（同时写入L1和L2）"""
+        if not self.redis:
+            self.memory_cache.set(key, value, expire)
+            return
+        
+        try:
+            payload = self.serializer_for(key).dumps(value)
+        except Exception as e:
+            logger.warning(f"缓存序列化失败 {key}: {e}")
+            self.memory_cache.set(key, value, self._local_ttl(expire))
+            return
+        
+        self.memory_cache.set(key, value, self._local_ttl(expire), size=len(payload))
+        try:
+            self.redis.setex(key, expire, payload)
+        except:
+            pass
+    
+    def serializer_for(self, key):
+        """按键的命名空间选择L2编解码器"""
+        namespace = key.split(':', 1)[0]
+        return self.namespace_serializers.get(namespace, self.serializer)
+    
+    def get_generation(self, namespace):
+        """获取命名空间当前代数"""
+        if not self.redis:
+            return self._generations.get(namespace, 0)
+        
+        generation = self._generation_cache.get(namespace)
+        if generation is None:
+            try:
+                generation = int(self.redis.get(f"ns:{namespace}:gen") or 0)
+            except:
+                return 0
+            self._generation_cache.set(namespace, generation)
+        return generation
+    
+    def namespaced_key(self, namespace, key):
+        """生成带命名空间代数的缓存键"""
+        return f"{namespace}:v{self.get_generation(namespace)}:{key}"
+    
+    def invalidate_namespace(self, namespace):
+        """递增命名空间代数，使该命名空间下的所有缓存逻辑失效（O(1)）"""
+        if self.redis:
+            try:
+                generation = self.redis.incr(f"ns:{namespace}:gen")
+                self._generation_cache.set(namespace, generation)
+            except:
+                logger.warning(f"命名空间失效失败: {namespace}")
+            return
+        
+        with self._generation_lock:
+            self._generations[namespace] = self._generations.get(namespace, 0) + 1
+    
+    def acquire_lock(self, key):
+        """获取跨进程重建锁，成功返回token，失败返回None；无Redis时总是成功"""
+        token = uuid.uuid4().hex
+        if not self.redis:
+            return token
+        try:
+            if self.redis.set(f"lock:{key}", token, nx=True, px=int(self.lock_timeout * 1000)):
+                return token
+            return None
+        except:
+            return token
+    
+    def release_lock(self, key, token):
+        """释放重建锁"""
+        if self.redis:
+            try:
+                self._release_lock(keys=[f"lock:{key}"], args=[token])
+            except:
+                pass
+    
+    def load(self, key, loader, expire=3600, cacheable=None):
+        """
+        在单飞保护下重建缓存
+        
+        进程内同一键只有一个线程执行loader，其余线程等待其结果；
+        跨worker通过Redis锁保证只有一个worker回源，其余worker轮询缓存直到结果写入，
+        等待超过lock_wait后自行回源。
+        cacheable(value)返回False时结果照常返回但不写入缓存（例如错误响应）。
+        """
+        return self._flight.do(key, lambda: self._load_with_lock(key, loader, expire, cacheable))
+    
+    def _load_with_lock(self, key, loader, expire, cacheable=None):
+        # 再次检查：等待期间其他worker可能已写入
+        value = self.get(key)
+        if value is not None:
+            return value
+        
+        token = self.acquire_lock(key)
+        if token is None:
+            # 持锁者的结果不可缓存或loader抛出异常时不会写入缓存，
+            # 锁一释放就接手回源，而不是等满lock_wait
+            deadline = time.monotonic() + self.lock_wait
+            while time.monotonic() < deadline:
+                time.sleep(0.05)
+                value = self.get(key)
+                if value is not None:
+                    return value
+                token = self.acquire_lock(key)
+                if token is not None:
+                    break
+            else:
+                logger.warning(f"等待缓存重建超时，自行回源: {key}")
+        
+        try:
+            value = loader()
+            if cacheable is None or cacheable(value):
+                self.set(key, value, expire)
+            return value
+        finally:
+            if token is not None:
+                self.release_lock(key, token)
+    
+    def get_or_refresh(self, key, loader, soft_ttl, hard_ttl, background_loader=None, cacheable=None):
+        """
+        stale-while-revalidate读取
+        
+        缓存中保存 {'value': ..., 'fresh_until': 时间戳}，整体在hard_ttl后过期。
+        - 软TTL内：直接返回
+        - 软TTL过期、硬TTL未过期：返回旧值，并提交后台刷新
+        - 硬TTL过期：单飞保护下同步回源
+        background_loader用于后台线程执行（例如绑定了请求上下文的loader），默认同loader。
+        """
+        def build():
+            return {'value': loader(), 'fresh_until': time.time() + soft_ttl}
+        
+        entry_cacheable = (lambda entry: cacheable(entry['value'])) if cacheable else None
+        
+        entry = self.get(key)
+        if entry is None:
+            entry = self.load(key, build, hard_ttl, entry_cacheable)
+        elif time.time() >= entry['fresh_until']:
+            self._schedule_refresh(key, background_loader or loader, soft_ttl, hard_ttl, cacheable)
+        return entry['value']
+    
+    def _schedule_refresh(self, key, loader, soft_ttl, hard_ttl, cacheable=None):
+        """提交后台刷新任务，队列已满或该键已在刷新时直接跳过"""
+        with self._refresh_lock:
+            if key in self._refreshing or len(self._refreshing) >= self._refresh_queue:
+                return False
+            self._refreshing.add(key)
+        
+        try:
+            self._refresh_executor.submit(self._refresh, key, loader, soft_ttl, hard_ttl, cacheable)
+        except RuntimeError:
+            with self._refresh_lock:
+                self._refreshing.discard(key)
+            return False
+        return True
+    
+    def _refresh(self, key, loader, soft_ttl, hard_ttl, cacheable=None):
+        """后台刷新：其他worker正在刷新时跳过，结果不可缓存时保留旧值"""
+        try:
+            token = self.acquire_lock(key)
+            if token is None:
+                return
+            try:
+                value = loader()
+                if cacheable is None or cacheable(value):
+                    self.set(key, {'value': value, 'fresh_until': time.time() + soft_ttl}, hard_ttl)
+            finally:
+                self.release_lock(key, token)
+        except Exception as e:
+            logger.error(f"后台刷新缓存失败 {key}: {e}")
+        finally:
+            with self._refresh_lock:
+                self._refreshing.discard(key)
+    
+    def delete(self, key):
+        """删除缓存"""
+        self.memory_cache.delete(key)
+        if self.redis:
+            try:
+                self.redis.delete(key)
+            except:
+                pass
+    
+    def clear_pattern(self, pattern):
+        """
+        删除匹配模式的缓存（用于运维清理，请求路径中应使用invalidate_namespace）
+        
+        Redis中使用SCAN增量遍历，避免KEYS阻塞服务器。
+        """
+        for key in self.memory_cache.keys():
+            if fnmatch.fnmatchcase(key, pattern):
+                self.memory_cache.delete(key)
+        
+        if self.redis:
+            try:
+                batch = []
+                for key in self.redis.scan_iter(match=pattern, count=500):
+                    batch.append(key)
+                    if len(batch) >= 500:
+                        self.redis.unlink(*batch)
+                        batch = []
+                if batch:
+                    self.redis.unlink(*batch)
+            except:
+                pass
+    
+    def stats(self):
+        """缓存统计信息"""
+        stats = {'l1': self.memory_cache.stats()}
+        if self.redis:
+            with self._stats_lock:
+                stats['l2'] = {'hits': self.l2_hits, 'misses': self.l2_misses}
+        return stats
+
+
+cache_manager = CacheManager(
+    redis_client,
+    max_entries=app.config['CACHE_MAX_ENTRIES'],
+    max_bytes=app.config['CACHE_MAX_BYTES'],
+    l1_max_entries=app.config['CACHE_L1_MAX_ENTRIES'],
+    l1_ttl=app.config['CACHE_L1_TTL'],
+    lock_timeout=app.config['CACHE_LOCK_TIMEOUT'],
+    lock_wait=app.config['CACHE_LOCK_WAIT'],
+    generation_ttl=app.config['CACHE_GENERATION_TTL'],
+    refresh_workers=app.config['CACHE_REFRESH_WORKERS'],
+    refresh_queue=app.config['CACHE_REFRESH_QUEUE'],
+    serializer=make_serializer(app.config['CACHE_SERIALIZER'], app.config['CACHE_COMPRESS_THRESHOLD']),
+    namespace_serializers={
+        namespace: make_serializer(name, app.config['CACHE_COMPRESS_THRESHOLD'])
+        for namespace, name in app.config['CACHE_NAMESPACE_SERIALIZERS'].items()
+    }
+)
+
+
+class ViewCounter:
+    """
+    浏览量缓冲计数
+    
+    浏览时只在Redis(HINCRBY)或进程内累加，由后台线程每flush_interval秒
+    用一条批量 UPDATE ... SET view_count = view_count + n 写回数据库，
+    读请求不再产生写事务，热门文章也不会在行锁上排队。
+    """
+    PENDING_KEY = 'post_views:pending'
+    
+    # 原子地取出并清空待写回计数，多个worker同时写回时不会重复累加
+    DRAIN_SCRIPT = """
+    local counts = redis.call('HGETALL', KEYS[1])
+    redis.call('DEL', KEYS[1])
+    return counts
+    """
+    
+    def __init__(self, redis_client=None, flush_interval=5):
+        self.redis = redis_client
+        self.flush_interval = flush_interval
+        self._pending = defaultdict(int)
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._drain = redis_client.register_script(self.DRAIN_SCRIPT) if redis_client else None
+    
+    def incr(self, post_id, n=1):
+        """累加浏览量，返回该文章尚未写回数据库的计数"""
+        self._ensure_flusher()
+        if self.redis:
+            try:
+                return self.redis.hincrby(self.PENDING_KEY, post_id, n)
+            except:
+                pass
+        
+        with self._lock:
+            self._pending[post_id] += n
+            return self._pending[post_id]
+    
+    def _take_pending(self):
+        """取出并清空待写回计数"""
+        counts = defaultdict(int)
+        if self.redis:
+            try:
+                raw = self._drain(keys=[self.PENDING_KEY])
+                for post_id, n in zip(raw[::2], raw[1::2]):
+                    counts[int(post_id)] += int(n)
+            except:
+                logger.warning("读取待写回浏览量失败")
+        
+        with self._lock:
+            for post_id, n in self._pending.items():
+                counts[post_id] += n
+            self._pending.clear()
+        return counts
+    
+    def flush(self):
+        """将缓冲的浏览量批量写回数据库（需要应用上下文），返回更新的文章数"""
+        counts = self._take_pending()
+        if not counts:
+            return 0
+        
+        table = Post.__table__
+        stmt = (
+            table.update()
+            .where(table.c.id == bindparam('post_id'))
+            # 保持updated_at不变，浏览量不算内容更新
+            .values(view_count=table.c.view_count + bindparam('n'), updated_at=table.c.updated_at)
+        )
+        try:
+            db.session.execute(stmt, [{'post_id': post_id, 'n': n} for post_id, n in counts.items()])
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"浏览量写回失败: {e}")
+            # 放回本地缓冲，下次重试
+            with self._lock:
+                for post_id, n in counts.items():
+                    self._pending[post_id] += n
+            return 0
+        return len(counts)
+    
+    def _ensure_flusher(self):
+        """首次计数时启动后台写回线程"""
+        if self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run_flusher, name='view-count-flusher', daemon=True)
+                self._flusher.start()
+                atexit.register(self._flush_in_context)
+    
+    def _flush_in_context(self):
+        with app.app_context():
+            return self.flush()
+    
+    def _run_flusher(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self._flush_in_context()
+            except Exception as e:
+                logger.error(f"浏览量写回线程错误: {e}")
+
+
+view_counter = ViewCounter(redis_client, flush_interval=app.config['VIEW_COUNT_FLUSH_INTERVAL'])
+
+
+# ====================== 5. 限流系统 ======================
+
+class ShardedStore:
+    """
+    分片内存存储
+    
+    键按哈希分布到多个分片，每个分片一把锁，降低多线程下的锁竞争。
+    每个条目带过期时间，访问分片时按sweep_interval顺带清理该分片的过期键（摊还清理），
+    空闲客户端的键不会永久占用内存。
+    """
+    
+    class _Shard:
+        __slots__ = ('lock', 'data', 'next_sweep')
+        
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.data = {}  # key -> (state, expires_at)
+            self.next_sweep = 0.0
+    
+    def __init__(self, shards=16, sweep_interval=60):
+        self._shards = [self._Shard() for _ in range(shards)]
+        self.sweep_interval = sweep_interval
+    
+    def _shard_for(self, key):
+        return self._shards[hash(key) % len(self._shards)]
+    
+    def update(self, key, fn, now):
+        """
+        在分片锁内原子地更新一个键
+        
+        fn(state) -> (new_state, expires_at, result)，state为None表示键不存在或已过期；
+        new_state为None时删除该键。返回result。
+        """
+        shard = self._shard_for(key)
+        with shard.lock:
+            if now >= shard.next_sweep:
+                self._sweep_shard(shard, now)
+            
+            entry = shard.data.get(key)
+            state = entry[0] if entry is not None and entry[1] > now else None
+            new_state, expires_at, result = fn(state)
+            
+            if new_state is None:
+                shard.data.pop(key, None)
+            else:
+                shard.data[key] = (new_state, expires_at)
+            return result
+    
+    def update_many(self, keys, fn, now):
+        """
+        原子地更新多个键
+        
+        按分片序号顺序加锁避免死锁；fn(states) -> (new_states, expires_list, result)。
+        """
+        shards = {id(self._shard_for(key)): self._shard_for(key) for key in keys}
+        ordered = sorted(shards.values(), key=self._shards.index)
+        for shard in ordered:
+            shard.lock.acquire()
+        try:
+            for shard in ordered:
+                if now >= shard.next_sweep:
+                    self._sweep_shard(shard, now)
+            
+            states = []
+            for key in keys:
+                entry = self._shard_for(key).data.get(key)
+                states.append(entry[0] if entry is not None and entry[1] > now else None)
+            
+            new_states, expires_list, result = fn(states)
+            for key, new_state, expires_at in zip(keys, new_states, expires_list):
+                data = self._shard_for(key).data
+                if new_state is None:
+                    data.pop(key, None)
+                else:
+                    data[key] = (new_state, expires_at)
+            return result
+        finally:
+            for shard in reversed(ordered):
+                shard.lock.release()
+    
+    def _sweep_shard(self, shard, now):
+        """清理分片中的过期键（调用方需持有分片锁）"""
+        expired = [key for key, (_, expires_at) in shard.data.items() if expires_at <= now]
+        for key in expired:
+            del shard.data[key]
+        shard.next_sweep = now + self.sweep_interval
+        return len(expired)
+    
+    def sweep(self, now=None):
+        """立即清理所有分片，返回删除的键数"""
+        now = time.time() if now is None else now
+        removed = 0
+        for shard in self._shards:
+            with shard.lock:
+                removed += self._sweep_shard(shard, now)
+        return removed
+    
+    def __len__(self):
+        return sum(len(shard.data) for shard in self._shards)
+    
+    def stats(self):
+        """键数量和内存占用估算（字节）"""
+        keys = 0
+        memory = 0
+        for shard in self._shards:
+            with shard.lock:
+                keys += len(shard.data)
+                memory += sys.getsizeof(shard.data)
+                for key, entry in shard.data.items():
+                    state = entry[0]
+                    memory += sys.getsizeof(key) + sys.getsizeof(entry) + sys.getsizeof(state)
+                    if isinstance(state, list):
+                        memory += sum(sys.getsizeof(item) for item in state)
+        return {'shards': len(self._shards), 'keys': keys, 'memory_bytes': memory}
+
+
+class RateLimitResult:
+    """限流检查结果，布尔值等价于是否允许"""
+    __slots__ = ('allowed', 'limit', 'remaining', 'reset_after', 'retry_after')
+    
+    def __init__(self, allowed, limit, remaining, reset_after, retry_after=0):
+        self.allowed = allowed
+        self.limit = limit
+        self.remaining = max(0, remaining)
+        self.reset_after = reset_after      # 配额完全恢复的秒数
+        self.retry_after = retry_after      # 被拒绝时建议的重试秒数
+    
+    def __bool__(self):
+        return self.allowed
+    
+    def __repr__(self):
+        return (f"RateLimitResult(allowed={self.allowed}, limit={self.limit}, remaining={self.remaining}, "
+                f"reset_after={self.reset_after:.3f}, retry_after={self.retry_after:.3f})")
+    
+    @staticmethod
+    def combine(results):
+        """合并多个限流结果：任一拒绝则拒绝（取最长重试时间），否则取剩余配额最少的"""
+        denied = [r for r in results if not r.allowed]
+        if denied:
+            worst = max(denied, key=lambda r: r.retry_after)
+        else:
+            worst = min(results, key=lambda r: r.remaining)
+        allowed = not denied
+        return RateLimitResult(allowed, worst.limit, worst.remaining, worst.reset_after,
+                               worst.retry_after if not allowed else 0)
+    
+    def headers(self):
+        """标准限流响应头，时间均为相对秒数"""
+        headers = {
+            'X-RateLimit-Limit': str(self.limit),
+            'X-RateLimit-Remaining': str(self.remaining),
+            'X-RateLimit-Reset': str(math.ceil(self.reset_after))
+        }
+        if not self.allowed:
+            headers['Retry-After'] = str(max(1, math.ceil(self.retry_after)))
+        return headers
+
+
+class RateLimiter:
+    """
+    限流器
+    
+    支持两种算法，Redis和内存后端语义一致：
+    - sliding_window: 滑动窗口日志，精确但每个键保存最多limit个时间戳
+    - gcra: 通用信元速率算法（令牌桶的等价形式），每个键只保存一个时间戳(TAT)，
+      允许瞬时突发limit个请求，之后按window/limit的间隔匀速放行
+    
+    is_allowed_many()在一次原子操作中检查多个键（例如按IP和按用户的限流）：
+    只有全部允许时才记录本次请求，每个键返回各自的RateLimitResult。
+    
+    指定sync_fraction时Redis后端使用近似模式（固定窗口计数）：每个worker先在本地计数，
+    本地累计达到 limit×sync_fraction 或估算值接近上限时才与Redis同步，远低于上限的客户端
+    大多数请求不产生网络往返。误差上限约为 worker数 × limit × sync_fraction。
+    """
+    
+    ALGORITHMS = ('sliding_window', 'gcra')
+    
+    # 滑动窗口：KEYS为各限流键，ARGV = now, member, 然后每个键依次为 limit, window
+    # 每个键返回 {是否允许, 剩余配额, 重置毫秒数, 重试毫秒数}
+    SLIDING_WINDOW_SCRIPT = """
+    local now = tonumber(ARGV[1])
+    local counts = {}
+    local all_allowed = true
+    
+    for i, key in ipairs(KEYS) do
+        local limit = tonumber(ARGV[1 + i * 2])
+        local window = tonumber(ARGV[2 + i * 2])
+        redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+        counts[i] = redis.call('ZCARD', key)
+        if counts[i] >= limit then
+            all_allowed = false
+        end
+    end
+    
+    local results = {}
+    for i, key in ipairs(KEYS) do
+        local limit = tonumber(ARGV[1 + i * 2])
+        local window = tonumber(ARGV[2 + i * 2])
+        local count = counts[i]
+        local allowed = count < limit
+        if all_allowed then
+            redis.call('ZADD', key, now, ARGV[2])
+            count = count + 1
+            redis.call('PEXPIRE', key, math.ceil(window * 1000))
+        end
+        
+        local reset = window
+        local oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+        if oldest[2] then
+            reset = tonumber(oldest[2]) + window - now
+        end
+        local retry = 0
+        if not allowed then
+            retry = reset
+        end
+        table.insert(results, allowed and 1 or 0)
+        table.insert(results, limit - count)
+        table.insert(results, math.ceil(reset * 1000))
+        table.insert(results, math.ceil(retry * 1000))
+    end
+    return results
+    """
+    
+    # GCRA：每个键只保存理论到达时间(TAT)，键在配额完全恢复时自动过期
+    # ARGV = now, 然后每个键依次为 limit, window
+    GCRA_SCRIPT = """
+    local now = tonumber(ARGV[1])
+    local plans = {}
+    local all_allowed = true
+    
+    for i, key in ipairs(KEYS) do
+        local limit = tonumber(ARGV[i * 2])
+        local window = tonumber(ARGV[1 + i * 2])
+        local interval = window / limit
+        local tat = tonumber(redis.call('GET', key)) or now
+        if tat < now then
+            tat = now
+        end
+        local new_tat = tat + interval
+        local allow_at = new_tat - window
+        -- 容差1微秒，避免浮点误差导致边界请求被误拒
+        local allowed = allow_at - now <= 1e-6
+        if not allowed then
+            all_allowed = false
+        end
+        plans[i] = {allowed, tat, new_tat, allow_at, interval}
+    end
+    
+    local results = {}
+    for i, key in ipairs(KEYS) do
+        local allowed, tat, new_tat, allow_at, interval = unpack(plans[i])
+        if not allowed then
+            table.insert(results, 0)
+            table.insert(results, 0)
+            table.insert(results, math.ceil((tat - now) * 1000))
+            table.insert(results, math.ceil((allow_at - now) * 1000))
+        else
+            local reset_tat = tat
+            if all_allowed then
+                redis.call('SET', key, string.format('%.6f', new_tat), 'PX', math.ceil((new_tat - now) * 1000))
+                reset_tat = new_tat
+            else
+                allow_at = allow_at - interval
+            end
+            table.insert(results, 1)
+            table.insert(results, math.floor((now - allow_at) / interval + 1e-9))
+            table.insert(results, math.ceil((reset_tat - now) * 1000))
+            table.insert(results, 0)
+        end
+    end
+    return results
+    """
+    
+    # 近似模式同步：KEYS为窗口计数器，ARGV每个键依次为 本地待同步数, limit, 过期毫秒数
+    # 先累加各worker本地已放行的请求，全部未超限时再为本次请求各加1
+    # 返回 {是否允许, 各键全局计数...}
+    APPROXIMATE_SYNC_SCRIPT = """
+    local totals = {}
+    local all_allowed = true
+    for i, key in ipairs(KEYS) do
+        local pending = tonumber(ARGV[i * 3 - 2])
+        local limit = tonumber(ARGV[i * 3 - 1])
+        local total
+        if pending > 0 then
+            total = redis.call('INCRBY', key, pending)
+            redis.call('PEXPIRE', key, ARGV[i * 3])
+        else
+            total = tonumber(redis.call('GET', key) or 0)
+        end
+        if total + 1 > limit then
+            all_allowed = false
+        end
+        totals[i] = total
+    end
+    
+    if all_allowed then
+        for i, key in ipairs(KEYS) do
+            totals[i] = redis.call('INCR', key)
+            redis.call('PEXPIRE', key, ARGV[i * 3])
+        end
+    end
+    
+    local results = {all_allowed and 1 or 0}
+    for i = 1, #totals do
+        table.insert(results, totals[i])
+    end
+    return results
+    """
+    
+    def __init__(self, redis_client=None, algorithm='sliding_window', shards=16, sweep_interval=60,
+                 sync_fraction=None):
+        if algorithm not in self.ALGORITHMS:
+            raise ValueError(f"未知的限流算法: {algorithm}")
+        
+        self.redis = redis_client
+        self.algorithm = algorithm
+        self.sync_fraction = sync_fraction
+        self.memory_store = ShardedStore(shards, sweep_interval) if not redis_client else None
+        self.redis_round_trips = 0
+        if redis_client:
+            script = self.GCRA_SCRIPT if algorithm == 'gcra' else self.SLIDING_WINDOW_SCRIPT
+            self._script = redis_client.register_script(script)
+            if sync_fraction is not None:
+                self.local_store = ShardedStore(shards, sweep_interval)
+                self._sync_script = redis_client.register_script(self.APPROXIMATE_SYNC_SCRIPT)
+    
+    def is_allowed(self, key, limit, window):
+        """检查是否允许请求，返回RateLimitResult"""
+        return self.is_allowed_many([(key, limit, window)])[0]
+    
+    def is_allowed_many(self, checks):
+        """
+        一次检查多个限流键
+        
+        checks: [(key, limit, window), ...]
+        全部允许时才记录本次请求；返回与checks顺序一致的RateLimitResult列表，
+        可用RateLimitResult.combine()得到总体结果。
+        """
+        now = time.time()
+        
+        if self.redis and self.sync_fraction is not None:
+            return self._approximate_check(checks, now)
+        if self.redis:
+            return self._redis_check(checks, now)
+        return self._memory_check(checks, now)
+    
+    def _redis_check(self, checks, now):
+        """Redis限流检查：所有键在一次脚本调用中完成"""
+        try:
+            keys = [key for key, _, _ in checks]
+            args = [now]
+            if self.algorithm == 'sliding_window':
+                # 成员带随机后缀，避免同一时间戳的请求互相覆盖
+                args.append(f"{now}:{uuid.uuid4().hex}")
+            for _, limit, window in checks:
+                args.extend([limit, window])
+            
+            self.redis_round_trips += 1
+            raw = self._script(keys=keys, args=args)
+            return [
+                RateLimitResult(bool(raw[i]), limit, raw[i + 1], raw[i + 2] / 1000, raw[i + 3] / 1000)
+                for i, (_, limit, _) in zip(range(0, len(raw), 4), checks)
+            ]
+        except:
+            return [RateLimitResult(True, limit, limit, window) for _, limit, window in checks]
+    
+    def _approximate_check(self, checks, now):
+        """近似限流检查：本地判断，必要时批量同步Redis（固定窗口计数）"""
+        keys = [key for key, _, _ in checks]
+        windows = [int(now // window) for _, _, window in checks]
+        expires = [(window_id + 1) * window for window_id, (_, _, window) in zip(windows, checks)]
+        
+        def current(states):
+            # 本地状态 [窗口序号, 本地待同步数, 最近一次看到的全局计数]
+            return [state if state is not None and state[0] == window_id else [window_id, 0, 0]
+                    for state, window_id in zip(states, windows)]
+        
+        # 阶段1：本地判断；None表示已知超限，True表示需要同步Redis
+        def plan(states):
+            states = current(states)
+            decisions = []
+            for state, (_, limit, _) in zip(states, checks):
+                batch = max(1, int(limit * self.sync_fraction))
+                estimate = state[1] + state[2]
+                if estimate >= limit:
+                    decisions.append(None)
+                else:
+                    decisions.append(state[1] + 1 >= batch or estimate + 1 > limit - batch)
+            
+            flushed = [0] * len(states)
+            if None not in decisions:
+                if any(decisions):
+                    for i, need_sync in enumerate(decisions):
+                        if need_sync:
+                            flushed[i], states[i][1] = states[i][1], 0
+                else:
+                    # 全部本地放行
+                    for state in states:
+                        state[1] += 1
+            return states, expires, (decisions, flushed)
+        
+        decisions, flushed = self.local_store.update_many(keys, plan, now)
+        
+        # 阶段2：需要时同步Redis
+        allowed = None not in decisions
+        totals = {}
+        if allowed and any(decisions):
+            sync_index = [i for i, need_sync in enumerate(decisions) if need_sync]
+            args = []
+            for i in sync_index:
+                _, limit, window = checks[i]
+                args.extend([flushed[i], limit, int(window * 1000) + 1000])
+            try:
+                self.redis_round_trips += 1
+                raw = self._sync_script(keys=[f"{keys[i]}:{windows[i]}" for i in sync_index], args=args)
+                allowed = bool(raw[0])
+                totals = dict(zip(sync_index, raw[1:]))
+            except:
+                # Redis不可用时放行，待同步数留在本地
+                totals = {}
+        
+        # 阶段3：记录同步结果
+        def record(states):
+            states = current(states)
+            for i, state in enumerate(states):
+                if i in totals:
+                    state[2] = max(state[2], totals[i])
+                elif decisions[i] and not totals:
+                    state[1] += flushed[i] + (1 if allowed else 0)
+                elif decisions[i] is False and allowed and any(decisions):
+                    state[1] += 1
+            
+            results = []
+            for state, (_, limit, window), window_id in zip(states, checks, windows):
+                reset = (window_id + 1) * window - now
+                results.append(RateLimitResult(allowed, limit, limit - state[1] - state[2], reset,
+                                               0 if allowed else reset))
+            return states, expires, results
+        
+        return self.local_store.update_many(keys, record, now)
+    
+    def _memory_check(self, checks, now):
+        """内存限流检查，与对应Lua脚本逻辑一致"""
+        keys = [key for key, _, _ in checks]
+        step = self._gcra_step if self.algorithm == 'gcra' else self._sliding_window_step
+        
+        def apply(states):
+            plans = [step(state, limit, window, now) for state, (_, limit, window) in zip(states, checks)]
+            all_allowed = all(allowed for allowed, _ in plans)
+            outcomes = [commit(all_allowed) for _, commit in plans]
+            return ([state for state, _, _ in outcomes],
+                    [expires_at for _, expires_at, _ in outcomes],
+                    [result for _, _, result in outcomes])
+        
+        return self.memory_store.update_many(keys, apply, now)
+    
+    @staticmethod
+    def _sliding_window_step(timestamps, limit, window, now):
+        """滑动窗口：返回 (本键是否允许, commit(是否记录) -> (新状态, 过期时间, 结果))"""
+        timestamps = timestamps or []
+        
+        # 时间戳有序，二分定位并删除过期记录
+        del timestamps[:bisect.bisect_right(timestamps, now - window)]
+        allowed = len(timestamps) < limit
+        
+        def commit(record):
+            if record:
+                timestamps.append(now)
+            reset = timestamps[0] + window - now if timestamps else window
+            result = RateLimitResult(allowed, limit, limit - len(timestamps), reset, 0 if allowed else reset)
+            # 最后一条记录过期后整个键即可删除
+            return timestamps or None, (timestamps[-1] + window if timestamps else now), result
+        
+        return allowed, commit
+    
+    @staticmethod
+    def _gcra_step(tat, limit, window, now):
+        """GCRA：返回 (本键是否允许, commit(是否记录) -> (新状态, 过期时间, 结果))"""
+        interval = window / limit
+        tat = max(tat if tat is not None else now, now)
+        new_tat = tat + interval
+        allow_at = new_tat - window
+        allowed = allow_at - now <= 1e-6
+        
+        def commit(record):
+            if not allowed:
+                return tat, tat, RateLimitResult(False, limit, 0, tat - now, allow_at - now)
+            if not record:
+                remaining = int((now - allow_at + interval) / interval + 1e-9)
+                return tat, tat, RateLimitResult(True, limit, remaining, tat - now)
+            
+            # 与Redis中保存的精度一致（微秒）；TAT之后配额已完全恢复，键可删除
+            stored_tat = round(new_tat, 6)
+            remaining = int((now - allow_at) / interval + 1e-9)
+            return stored_tat, stored_tat, RateLimitResult(True, limit, remaining, new_tat - now)
+        
+        return allowed, commit
+    
+    def stats(self):
+        """限流存储统计信息"""
+        if self.memory_store is not None:
+            return self.memory_store.stats()
+        stats = {'redis_round_trips': self.redis_round_trips}
+        if self.sync_fraction is not None:
+            stats['local'] = self.local_store.stats()
+        return stats
+
+
+rate_limiter = RateLimiter(
+    redis_client,
+    algorithm=app.config['RATE_LIMIT_ALGORITHM'],
+    shards=app.config['RATE_LIMIT_SHARDS'],
+    sweep_interval=app.config['RATE_LIMIT_SWEEP_INTERVAL'],
+    sync_fraction=app.config['RATE_LIMIT_SYNC_FRACTION']
+)
+
+
+# ====================== 6. 装饰器 ======================
 
-class CacheManager:
-    """缓存管理器"""
+class TokenDenylist:
+    """
+    令牌吊销列表 - 按用户记录最小有效令牌版本
     
-    def __init__(self, redis_client=None):
-        self.redis = redis_client
-        self.memory_cache = {} if not redis_client else None
+    每个用户只占一个键，键在JWT最长有效期后过期（届时旧令牌已自然失效）。
+    Redis中的值在本地缓存check_ttl秒，避免每个请求都访问Redis。
+    """
     
-    def get(self, key):
-        """获取缓存"""
-        if self.redis:
-            try:
-                value = self.redis.get(key)
-                return json.loads(value) if value else None
-            except:
-                return None
-        else:
-            return self.memory_cache.get(key)
+    def __init__(self, redis_client=None, ttl=86400, check_ttl=1):
+        self.redis = redis_client
+        self.ttl = int(ttl)
+        self._local = {}  # user_id -> (最小有效版本, 过期时间)，无Redis时使用
+        self._lock = threading.Lock()
+        self._checked = LocalCache(max_entries=10000, default_ttl=check_ttl)
     
-    def set(self, key, value, expire=3600):
-        """设置缓存"""
+    def revoke_before(self, user_id, version):
+        """吊销该用户版本号小于version的所有令牌"""
+        self._checked.delete(user_id)
         if self.redis:
             try:
-                self.redis.setex(key, expire, json.dumps(value))
+                self.redis.set(f"token_denylist:{user_id}", version, ex=self.ttl)
+                return
             except:
-                pass
-        else:
-            self.memory_cache[key] = value
+                logger.error(f"写入令牌吊销列表失败: {user_id}")
+        
+        now = time.time()
+        with self._lock:
+            # 顺带清理已过期的记录
+            for key in [k for k, (_, expires_at) in self._local.items() if expires_at <= now]:
+                del self._local[key]
+            self._local[user_id] = (version, now + self.ttl)
     
-    def delete(self, key):
-        """删除缓存"""
+    def _min_version(self, user_id):
+        min_version = self._checked.get(user_id)
+        if min_version is not None:
+            return min_version
+        
+        min_version = 0
         if self.redis:
             try:
-                self.redis.delete(key)
+                min_version = int(self.redis.get(f"token_denylist:{user_id}") or 0)
             except:
                 pass
-        else:
-            self.memory_cache.pop(key, None)
+        
+        with self._lock:
+            entry = self._local.get(user_id)
+            if entry is not None and entry[1] > time.time():
+                min_version = max(min_version, entry[0])
+        
+        self._checked.set(user_id, min_version)
+        return min_version
     
-    def clear_pattern(self, pattern):
-        """删除匹配模式的缓存"""
-        if self.redis:
-            try:
-                keys = self.redis.keys(pattern)
-                if keys:
-                    self.redis.delete(*keys)
-            except:
-                pass
-        else:
-            keys_to_delete = [k for k in self.memory_cache.keys() if pattern.replace('*', '') in k]
-            for key in keys_to_delete:
-                del self.memory_cache[key]
+    def is_revoked(self, user_id, version):
+        """令牌版本是否已被吊销"""
+        return version < self._min_version(user_id)
+
 
+token_denylist = TokenDenylist(
+    redis_client,
+    ttl=app.config['JWT_EXPIRATION_DELTA'].total_seconds(),
+    check_ttl=app.config['CACHE_GENERATION_TTL']
+)
 
-cache_manager = CacheManager(redis_client)
 
+def _principal_namespace(user_id):
+    return f"user:{user_id}"
 
-# ====================== 5. 限流系统 ======================
 
-class RateLimiter:
-    """限流器"""
+def load_principal(token, payload=None):
+    """
+    验证令牌并返回用户快照
     
-    def __init__(self, redis_client=None):
-        self.redis = redis_client
-        self.memory_store = defaultdict(list) if not redis_client else None
-        self.lock = threading.Lock() if not redis_client else None
+    快照按令牌哈希缓存在该用户的缓存命名空间下，缓存命中时认证请求不访问数据库；
+    用户行更新或删除时通过invalidate_principal()使该用户的所有快照失效。
+    已解码的payload可直接传入，避免重复校验签名。
+    """
+    if payload is None:
+        payload = User.decode_token(token)
+    if payload is None:
+        return None
     
-    def is_allowed(self, key, limit, window):
-        """检查是否允许请求"""
-        now = time.time()
-        
-        if self.redis:
-            return self._redis_check(key, limit, window, now)
-        else:
-            return self._memory_check(key, limit, window, now)
+    user_id = payload['user_id']
+    token_hash = hashlib.sha256(token.encode('utf-8')).hexdigest()
+    cache_key = cache_manager.namespaced_key(_principal_namespace(user_id), f"principal:{token_hash}")
     
-    def _redis_check(self, key, limit, window, now):
-        """Redis限流检查"""
-        try:
-            pipe = self.redis.pipeline()
-            pipe.zremrangebyscore(key, 0, now - window)
-            pipe.zcard(key)
-            pipe.zadd(key, {str(now): now})
-            pipe.expire(key, int(window) + 1)
-            results = pipe.execute()
-            
-            return results[1] < limit
-        except:
-            return True
+    data = cache_manager.get(cache_key)
+    if data is None:
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        data = user.to_dict()
+        cache_manager.set(cache_key, data, app.config['AUTH_CACHE_TTL'])
     
-    def _memory_check(self, key, limit, window, now):
-        """内存限流检查"""
-        with self.lock:
-            timestamps = self.memory_store[key]
-            
-            # 清理过期记录
-            timestamps[:] = [t for t in timestamps if now - t < window]
-            
-            if len(timestamps) < limit:
-                timestamps.append(now)
-                return True
-            
-            return False
+    return UserSnapshot(data)
 
 
-rate_limiter = RateLimiter(redis_client)
+def invalidate_principal(user_id):
+    """使用户的认证快照缓存失效"""
+    cache_manager.invalidate_namespace(_principal_namespace(user_id))
 
 
-# ====================== 6. 装饰器 ======================
+@event.listens_for(User, 'before_update')
+def _bump_token_version(mapper, connection, target):
+    """禁用或角色变更时递增令牌版本（密码哈希按新成本重算不应使令牌失效）"""
+    state = inspect(target)
+    if any(state.attrs[name].history.has_changes() for name in ('is_active', 'is_admin')):
+        target.token_version = (target.token_version or 0) + 1
+
+
+def _record_principal_change(target, revoke_version=None):
+    """
+    记录需要失效的用户，提交后再处理
+    
+    after_update/after_delete在flush中执行，此时事务尚未提交；如果这里就递增代数，
+    其他请求会读到旧的已提交行并缓存到新代数下，直到AUTH_CACHE_TTL过期。
+    """
+    changes = inspect(target).session.info.setdefault('principal_changes', {})
+    if revoke_version is not None:
+        changes[target.id] = max(changes.get(target.id) or 0, revoke_version)
+    else:
+        changes.setdefault(target.id, None)
+
+
+@event.listens_for(User, 'after_update')
+def _invalidate_principal_on_change(mapper, connection, target):
+    """用户被禁用、角色变更或其他字段更新时清除认证缓存，令牌版本变化时吊销旧令牌"""
+    revoke_version = None
+    if inspect(target).attrs.token_version.history.has_changes():
+        revoke_version = target.token_version
+    _record_principal_change(target, revoke_version)
+
+
+@event.listens_for(User, 'after_delete')
+def _invalidate_principal_on_delete(mapper, connection, target):
+    """用户删除时清除认证缓存并吊销其所有令牌"""
+    _record_principal_change(target, (target.token_version or 0) + 1)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _apply_principal_changes(session):
+    for user_id, revoke_version in session.info.pop('principal_changes', {}).items():
+        if revoke_version is not None:
+            token_denylist.revoke_before(user_id, revoke_version)
+        invalidate_principal(user_id)
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _discard_principal_changes(session):
+    session.info.pop('principal_changes', None)
+
+
+def authenticate(token):
+    """
+    根据令牌得到当前用户身份
+    
+    令牌带有声明(ver)时直接由声明授权，只检查吊销列表；否则加载缓存的用户快照。
+    """
+    payload = User.decode_token(token)
+    if payload is None:
+        return None
+    
+    if app.config['JWT_CLAIMS_MODE'] and 'ver' in payload:
+        if token_denylist.is_revoked(payload['user_id'], payload['ver']):
+            return None
+        return ClaimsPrincipal(payload)
+    
+    return load_principal(token, payload)
+
 
 def auth_required(f):
     """认证装饰器"""
@@ -261,7 +2081,7 @@ def auth_required(f):
         
         try:
             token = token.replace('Bearer ', '')
-            user = User.verify_token(token)
+            user = authenticate(token)
             
             if not user:
                 return jsonify({'error': '无效的令牌'}), 401
@@ -270,6 +2090,7 @@ def auth_required(f):
                 return jsonify({'error': '用户已被禁用'}), 401
             
             g.current_user = user
+            g.auth_token = token
             
         except Exception as e:
             logger.error(f"认证错误: {e}")
@@ -292,8 +2113,82 @@ def admin_required(f):
     return decorated
 
 
-def rate_limit_decorator(limit=100, window=3600, key_func=None):
-    """限流装饰器"""
+def _replica_sticky_key():
+    """
+    粘滞标记按用户区分（按IP时代理/NAT后的所有客户端会共用一个标记）
+    
+    公开的读接口不经过auth_required，从请求携带的令牌中取用户ID；
+    匿名请求没有写入能力，返回None。
+    """
+    user = g.get('current_user')
+    if user is not None:
+        user_id = user.id
+    else:
+        token = request.headers.get('Authorization', '').replace('Bearer ', '')
+        payload = User.decode_token(token) if token else None
+        user_id = payload['user_id'] if payload else None
+    return f"replica_sticky:user:{user_id}" if user_id is not None else None
+
+
+def is_replica_sticky():
+    """当前请求的用户是否刚提交过写入（每个请求只查一次）"""
+    if 'db_sticky' not in g:
+        key = _replica_sticky_key()
+        g.db_sticky = key is not None and cache_manager.get(key) is not None
+    return g.db_sticky
+
+
+def should_read_replica():
+    """当前请求的读查询能否使用只读副本"""
+    if not has_request_context() or not g.get('db_read_only'):
+        return False
+    return not is_replica_sticky()
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _record_session_write(session, flush_context):
+    session.info['has_writes'] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def mark_replica_sticky(session):
+    """提交过写入后，该客户端在REPLICA_STICKY_SECONDS内的读请求都发往主库"""
+    if not session.info.pop('has_writes', False):
+        return
+    if not has_request_context() or REPLICA_BIND_KEY not in db.engines:
+        return
+    g.db_sticky = True
+    key = _replica_sticky_key()
+    if key is not None:
+        cache_manager.set(key, 1, expire=app.config['REPLICA_STICKY_SECONDS'])
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _clear_session_write(session):
+    session.info.pop('has_writes', None)
+
+
+def read_only(f):
+    """只读视图装饰器：视图中的查询可以发往只读副本"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        previous = g.get('db_read_only', False)
+        g.db_read_only = True
+        try:
+            return f(*args, **kwargs)
+        finally:
+            g.db_read_only = previous
+    
+    return decorated
+
+
+def rate_limit_decorator(limit=100, window=3600, key_func=None, user_limit=None):
+    """
+    限流装饰器
+    
+    user_limit=(limit, window)时，对已认证用户额外按用户ID限流，
+    与按IP的限流在一次检查中完成。响应中带有X-RateLimit-*头，被拒绝时带Retry-After。
+    """
     def decorator(f):
         @wraps(f)
         def decorated(*args, **kwargs):
@@ -303,41 +2198,137 @@ def rate_limit_decorator(limit=100, window=3600, key_func=None):
             else:
                 key = f"rate_limit:{request.remote_addr}:{f.__name__}"
             
-            if not rate_limiter.is_allowed(key, limit, window):
-                return jsonify({
+            checks = [(key, limit, window)]
+            current_user = getattr(g, 'current_user', None)
+            if user_limit and current_user is not None:
+                checks.append((f"rate_limit:user:{current_user.id}:{f.__name__}", *user_limit))
+            
+            result = RateLimitResult.combine(rate_limiter.is_allowed_many(checks))
+            if not result:
+                response = jsonify({
                     'error': '请求过于频繁',
-                    'retry_after': window
-                }), 429
+                    'retry_after': max(1, math.ceil(result.retry_after))
+                })
+                response.status_code = 429
+                metrics_registry.inc('rate_limit_rejections_total', {'endpoint': f.__name__})
+            else:
+                response = app.make_response(f(*args, **kwargs))
             
-            return f(*args, **kwargs)
+            response.headers.update(result.headers())
+            return response
         
         return decorated
     return decorator
 
 
-def cache_result(expire=3600, key_func=None):
-    """缓存装饰器"""
+def _response_to_entry(rv):
+    """
+    将视图返回值转换为可缓存的响应条目：编码后的body、状态码、头部和ETag
+    
+    body以UTF-8文本保存，条目可以用JSON编解码器写入Redis；
+    非UTF-8的body保留为bytes，由_cacheable_entry()拒绝缓存。
+    """
+    response = app.make_response(rv)
+    body = response.get_data()
+    etag = hashlib.sha1(body).hexdigest()
+    response.set_etag(etag)
+    headers = [(k, v) for k, v in response.headers.items() if k.lower() != 'content-length']
+    try:
+        body = body.decode('utf-8')
+    except UnicodeDecodeError:
+        pass
+    return {'body': body, 'status': response.status_code, 'headers': headers, 'etag': etag}
+
+
+def _cacheable_entry(entry):
+    return entry['status'] == 200 and isinstance(entry['body'], str)
+
+
+def _entry_to_response(entry):
+    """由缓存条目直接构造响应，不再重复JSON编码；客户端持有相同ETag时返回304"""
+    build = lambda: app.response_class(entry['body'], status=entry['status'], headers=entry['headers'])
+    if entry['status'] == 200 and has_request_context():
+        return conditional_response(entry['etag'], build)
+    return build()
+
+
+def conditional_response(etag, build, weak=False):
+    """条件GET：If-None-Match匹配时返回304（不生成body），否则调用build()生成完整响应并附加ETag"""
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.make_response(build())
+    response.set_etag(etag, weak=weak)
+    return response
+
+
+def cache_result(expire=3600, key_func=None, single_flight=True, namespace=None, soft_ttl=None,
+                 response=False):
+    """
+    缓存装饰器
+    
+    single_flight=True时，缓存未命中的并发请求只有一个会执行被装饰函数，
+    其余请求等待并复用其结果，避免缓存失效瞬间的回源风暴。
+    
+    指定namespace时缓存键带有命名空间代数，可通过
+    cache_manager.invalidate_namespace(namespace)一次性失效。
+    
+    指定soft_ttl时启用stale-while-revalidate：expire为硬TTL，
+    软TTL过期后立即返回旧值并在后台线程池中刷新。
+    
+    response=True时缓存视图最终编码的响应（body字节、头部和ETag），
+    命中时直接用缓存的body构造响应；只缓存200且body为UTF-8的响应，
+    条目可以用默认的JSON编解码器写入Redis。
+    """
     def decorator(f):
+        if response:
+            cacheable = _cacheable_entry
+        else:
+            cacheable = None
+        
         @wraps(f)
         def decorated(*args, **kwargs):
+            # 刚写入的用户绕过共享缓存：缓存可能已被其他客户端从滞后的副本重新填充
+            if has_request_context() and REPLICA_BIND_KEY in db.engines and is_replica_sticky():
+                return f(*args, **kwargs)
+            
             # 生成缓存键
             if key_func:
                 cache_key = key_func(*args, **kwargs)
             else:
                 cache_key = f"cache:{f.__name__}:{hash(str(args) + str(kwargs))}"
             
+            if namespace:
+                cache_key = cache_manager.namespaced_key(namespace, cache_key)
+            
+            if response:
+                loader = lambda: _response_to_entry(f(*args, **kwargs))
+            else:
+                loader = lambda: f(*args, **kwargs)
+            
+            if soft_ttl is not None:
+                # 后台刷新需要在当前请求上下文中执行被装饰函数
+                background_loader = copy_current_request_context(loader) if has_request_context() else loader
+                result = cache_manager.get_or_refresh(cache_key, loader, soft_ttl, expire,
+                                                      background_loader, cacheable)
+                return _entry_to_response(result) if response else result
+            
             # 尝试从缓存获取
-            cached_result = cache_manager.get(cache_key)
-            if cached_result is not None:
+            result = cache_manager.get(cache_key)
+            if result is not None:
                 logger.info(f"缓存命中: {cache_key}")
-                return cached_result
+                return _entry_to_response(result) if response else result
             
             # 执行函数并缓存结果
-            result = f(*args, **kwargs)
-            cache_manager.set(cache_key, result, expire)
+            if single_flight:
+                result = cache_manager.load(cache_key, loader, expire, cacheable)
+            else:
+                result = loader()
+                if cacheable is None or cacheable(result):
+                    cache_manager.set(cache_key, result, expire)
             logger.info(f"缓存存储: {cache_key}")
             
-            return result
+            return _entry_to_response(result) if response else result
         
         return decorated
     return decorator
@@ -380,6 +2371,10 @@ def register():
             'user': user.to_dict()
         }), 201
         
+    except HashingBusyError:
+        db.session.rollback()
+        return jsonify({'error': '服务繁忙，请稍后重试'}), 503, {'Retry-After': '1'}
+        
     except Exception as e:
         db.session.rollback()
         logger.error(f"注册错误: {e}")
@@ -405,6 +2400,10 @@ def login():
         if not user.is_active:
             return jsonify({'error': '用户已被禁用'}), 401
         
+        # 哈希成本调整后，登录时透明地按新配置重新计算
+        if password_hasher.needs_rehash(user.password_hash):
+            user.set_password(data['password'])
+        
         # 更新最后登录时间
         user.last_login = datetime.utcnow()
         db.session.commit()
@@ -420,6 +2419,10 @@ def login():
             'user': user.to_dict()
         })
         
+    except HashingBusyError:
+        db.session.rollback()
+        return jsonify({'error': '服务繁忙，请稍后重试'}), 503, {'Retry-After': '1'}
+        
     except Exception as e:
         logger.error(f"登录错误: {e}")
         return jsonify({'error': '登录失败'}), 500
@@ -429,41 +2432,98 @@ def login():
 @auth_required
 def get_profile():
     """获取用户资料"""
+    user = g.current_user
+    if isinstance(user, ClaimsPrincipal):
+        # 令牌声明只包含授权字段，完整资料从缓存的用户快照读取
+        user = load_principal(g.auth_token)
+        if user is None:
+            return jsonify({'error': '用户不存在'}), 404
+    
     return jsonify({
-        'user': g.current_user.to_dict()
+        'user': user.to_dict()
     })
 
 
 @app.route('/api/posts', methods=['GET'])
-@cache_result(expire=300, key_func=lambda: f"posts:{request.args.to_dict()}")
+@cache_result(expire=300, soft_ttl=30, namespace='posts', response=True, key_func=lambda: str(request.args.to_dict()))
+@read_only
 def get_posts():
-    """获取文章列表"""
+    """
+    获取文章列表
+    
+    默认使用游标分页（after/before参数），include_total=1时才计算总数；
+    传page参数时保持原来的OFFSET分页。
+    """
     try:
-        page = request.args.get('page', 1, type=int)
         per_page = request.args.get('per_page', 10, type=int)
         per_page = min(per_page, 100)  # 限制每页最大数量
         
-        query = Post.query.filter_by(published=True)
+        # 一次JOIN加载作者，避免to_dict()中逐条查询author（N+1）
+        query = Post.query.options(db.joinedload(Post.author)).filter_by(published=True)
         
-        # 搜索
         search = request.args.get('search')
+        
+        # 全文搜索：按相关度排序，游标保存偏移量
+        if search and 'page' not in request.args and post_search.available():
+            cursor = request.args.get('after') or request.args.get('before')
+            offset = 0
+            if cursor:
+                token = _decode_token(cursor)
+                offset = token.get('offset') if isinstance(token, dict) else None
+                if not isinstance(offset, int) or offset < 0:
+                    raise InvalidCursorError(f"无效的分页游标: {cursor}")
+            
+            ids = post_search.search(search, per_page + 1, offset)
+            if ids is not None:
+                has_more = len(ids) > per_page
+                ids = ids[:per_page]
+                by_id = {post.id: post for post in query.filter(Post.id.in_(ids))} if ids else {}
+                
+                return jsonify({
+                    'posts': [by_id[post_id].to_dict() for post_id in ids if post_id in by_id],
+                    'pagination': {
+                        'per_page': per_page,
+                        'has_more': has_more,
+                        'next_cursor': _encode_token({'offset': offset + per_page}) if has_more else None,
+                        'prev_cursor': _encode_token({'offset': max(offset - per_page, 0)}) if offset else None,
+                    }
+                })
+        
+        # 没有FTS索引时回退到LIKE（无法使用索引）
         if search:
             query = query.filter(Post.title.contains(search))
         
-        posts = query.order_by(Post.created_at.desc()).paginate(
-            page=page, per_page=per_page, error_out=False
+        if 'page' in request.args:
+            page = request.args.get('page', 1, type=int)
+            posts = query.order_by(Post.created_at.desc()).paginate(
+                page=page, per_page=per_page, error_out=False
+            )
+            
+            return jsonify({
+                'posts': [post.to_dict() for post in posts.items],
+                'pagination': {
+                    'page': page,
+                    'pages': posts.pages,
+                    'per_page': per_page,
+                    'total': posts.total
+                }
+            })
+        
+        posts, pagination = keyset_paginate(
+            query, Post, per_page,
+            after=request.args.get('after'),
+            before=request.args.get('before')
         )
+        if request.args.get('include_total', type=int):
+            pagination['total'] = query.order_by(None).count()
         
         return jsonify({
-            'posts': [post.to_dict() for post in posts.items],
-            'pagination': {
-                'page': page,
-                'pages': posts.pages,
-                'per_page': per_page,
-                'total': posts.total
-            }
+            'posts': [post.to_dict() for post in posts],
+            'pagination': pagination
         })
         
+    except InvalidCursorError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         logger.error(f"获取文章列表错误: {e}")
         return jsonify({'error': '获取文章失败'}), 500
@@ -471,7 +2531,7 @@ def get_posts():
 
 @app.route('/api/posts', methods=['POST'])
 @auth_required
-@rate_limit_decorator(limit=20, window=3600)  # 1小时内最多20篇
+@rate_limit_decorator(limit=20, window=3600, user_limit=(20, 3600))  # 每个IP/用户1小时内最多20篇
 def create_post():
     """创建文章"""
     try:
@@ -491,7 +2551,7 @@ def create_post():
         db.session.commit()
         
         # 清理相关缓存
-        cache_manager.clear_pattern('posts:*')
+        cache_manager.invalidate_namespace('posts')
         
         logger.info(f"用户 {g.current_user.username} 创建文章: {post.title}")
         
@@ -507,6 +2567,7 @@ def create_post():
 
 
 @app.route('/api/posts/<int:post_id>', methods=['GET'])
+@read_only
 def get_post(post_id):
     """获取单篇文章"""
     try:
@@ -515,13 +2576,20 @@ def get_post(post_id):
         if not post.published and (not hasattr(g, 'current_user') or g.current_user.id != post.user_id):
             return jsonify({'error': '文章不存在'}), 404
         
-        # 增加浏览量
-        post.view_count += 1
-        db.session.commit()
+        # 弱ETag：内容只随updated_at变化，浏览量变化不影响
+        etag = f"post-{post.id}-{post.updated_at.timestamp()}"
         
-        return jsonify({
-            'post': post.to_dict()
-        })
+        # 增加浏览量：先缓冲，定期批量写回数据库
+        pending_views = view_counter.incr(post.id)
+        
+        def build():
+            data = post.to_dict()
+            data['view_count'] += pending_views
+            return jsonify({
+                'post': data
+            })
+        
+        return conditional_response(etag, build, weak=True)
         
     except Exception as e:
         logger.error(f"获取文章错误: {e}")
@@ -531,26 +2599,44 @@ def get_post(post_id):
 @app.route('/api/admin/users', methods=['GET'])
 @auth_required
 @admin_required
+@read_only
 def admin_get_users():
-    """管理员获取用户列表"""
+    """管理员获取用户列表（游标分页，传page时使用OFFSET分页）"""
     try:
-        page = request.args.get('page', 1, type=int)
         per_page = request.args.get('per_page', 20, type=int)
+        per_page = min(per_page, 100)
         
-        users = User.query.order_by(User.created_at.desc()).paginate(
-            page=page, per_page=per_page, error_out=False
+        if 'page' in request.args:
+            page = request.args.get('page', 1, type=int)
+            users = User.query.order_by(User.created_at.desc()).paginate(
+                page=page, per_page=per_page, error_out=False
+            )
+            
+            return jsonify({
+                'users': [user.to_dict() for user in users.items],
+                'pagination': {
+                    'page': page,
+                    'pages': users.pages,
+                    'per_page': per_page,
+                    'total': users.total
+                }
+            })
+        
+        users, pagination = keyset_paginate(
+            User.query, User, per_page,
+            after=request.args.get('after'),
+            before=request.args.get('before')
         )
+        if request.args.get('include_total', type=int):
+            pagination['total'] = User.query.count()
         
         return jsonify({
-            'users': [user.to_dict() for user in users.items],
-            'pagination': {
-                'page': page,
-                'pages': users.pages,
-                'per_page': per_page,
-                'total': users.total
-            }
+            'users': [user.to_dict() for user in users],
+            'pagination': pagination
         })
         
+    except InvalidCursorError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         logger.error(f"获取用户列表错误: {e}")
         return jsonify({'error': '获取用户列表失败'}), 500
@@ -577,10 +2663,346 @@ def bad_request(error):
 
 # ====================== 9. 中间件 ======================
 
+class MetricsRegistry:
+    """
+    进程内指标注册表 - 计数器和直方图，输出Prometheus文本格式
+    
+    记录时只在锁内做一次字典加法。collector在快照时读取其他组件自己维护的
+    累计值（缓存命中数等），derived在合并后计算比值类的gauge。
+    多进程部署时设置multiproc_dir：每个进程由后台线程定期把快照写入 <pid>.json，
+    抓取时合并目录中的所有快照，相同名称和标签的值相加。已退出进程的快照
+    由后台线程合并进 retired.json 后删除，目录中的文件数不随worker重启增长。
+    """
+    
+    RETIRED_FILENAME = 'retired.json'
+    
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    
+    def __init__(self, multiproc_dir=None, dump_interval=5):
+        self.multiproc_dir = multiproc_dir
+        self.dump_interval = dump_interval
+        self._lock = threading.Lock()
+        self._meta = {}        # name -> (type, help, buckets)
+        self._counters = {}    # name -> {labels: value}
+        self._histograms = {}  # name -> {labels: [bucket_counts, sum]}
+        self._collectors = []
+        self._derived = []
+        self._dump_lock = threading.Lock()
+        self._dumped_pid = None   # 写过快照的进程，fork后与os.getpid()不同
+        self._dumper_pid = None
+        
+        if multiproc_dir:
+            os.makedirs(multiproc_dir, exist_ok=True)
+            atexit.register(self.dump)
+    
+    def counter(self, name, help_text):
+        self._meta[name] = ('counter', help_text, None)
+        self._counters[name] = {}
+    
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self._meta[name] = ('histogram', help_text, tuple(buckets))
+        self._histograms[name] = {}
+    
+    def collector(self, func):
+        """注册快照时调用的函数，返回 [(计数器名, 标签dict, 累计值), ...]"""
+        self._collectors.append(func)
+        return func
+    
+    def derived(self, name, help_text, func):
+        """注册gauge：func(counters)根据合并后的计数器返回 {标签: 值}"""
+        self._meta[name] = ('gauge', help_text, None)
+        self._derived.append((name, func))
+    
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted(labels.items())) if labels else ()
+    
+    def inc(self, name, labels=None, value=1):
+        key = self._labels(labels)
+        with self._lock:
+            series = self._counters[name]
+            series[key] = series.get(key, 0) + value
+    
+    def observe(self, name, value, labels=None):
+        key = self._labels(labels)
+        buckets = self._meta[name][2]
+        index = bisect.bisect_left(buckets, value)
+        with self._lock:
+            series = self._histograms[name]
+            state = series.get(key)
+            if state is None:
+                state = series[key] = [[0] * (len(buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+    
+    def snapshot(self):
+        """当前进程的快照（可JSON序列化）"""
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            histograms = {
+                name: {key: [list(state[0]), state[1]] for key, state in series.items()}
+                for name, series in self._histograms.items()
+            }
+        
+        for collect in self._collectors:
+            try:
+                for name, labels, value in collect():
+                    counters.setdefault(name, {})[self._labels(labels)] = value
+            except Exception as e:
+                logger.warning(f"指标采集失败 {collect.__name__}: {e}")
+        
+        return {
+            'counters': {name: [[list(key), value] for key, value in series.items()]
+                         for name, series in counters.items()},
+            'histograms': {name: [[list(key), state[0], state[1]] for key, state in series.items()]
+                           for name, series in histograms.items()},
+        }
+    
+    def _snapshot_path(self, pid=None):
+        return os.path.join(self.multiproc_dir, f"{pid or os.getpid()}.json")
+    
+    @staticmethod
+    def _write_json(path, value):
+        """先写临时文件再原子替换，读取方不会看到写了一半的文件"""
+        with open(path + '.tmp', 'w') as f:
+            json.dump(value, f)
+        os.replace(path + '.tmp', path)
+    
+    def dump(self):
+        """把当前进程的快照写入multiproc_dir"""
+        if not self.multiproc_dir:
+            return
+        with self._dump_lock:
+            if self._dumped_pid != os.getpid():
+                # pid被复用时，同名快照属于已退出的旧进程，先合并再开始覆盖
+                self._retire_snapshots(include_own=True)
+                self._dumped_pid = os.getpid()
+            try:
+                self._write_json(self._snapshot_path(), self.snapshot())
+            except OSError as e:
+                logger.warning(f"写入指标快照失败: {e}")
+    
+    def ensure_dumper(self):
+        """
+        启动当前进程的后台快照线程，请求中不再同步写文件
+        
+        按pid判断：fork出的worker不继承父进程的线程，首个请求时各自启动。
+        """
+        if not self.multiproc_dir or self._dumper_pid == os.getpid():
+            return
+        with self._lock:
+            if self._dumper_pid == os.getpid():
+                return
+            self._dumper_pid = os.getpid()
+        threading.Thread(target=self._run_dumper, name='metrics-dumper', daemon=True).start()
+    
+    def _run_dumper(self):
+        while True:
+            time.sleep(self.dump_interval)
+            try:
+                self.dump()
+                self._retire_snapshots()
+            except Exception as e:
+                logger.error(f"指标快照线程错误: {e}")
+    
+    @staticmethod
+    def _process_alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+    
+    def _retire_snapshots(self, include_own=False):
+        """
+        把已退出进程的 <pid>.json 合并进 retired.json 并删除
+        
+        多个worker可能同时清理，用目录下的文件锁串行化读-改-写；
+        没有fcntl的平台（Windows）不清理。
+        """
+        if fcntl is None:
+            return
+        try:
+            with open(os.path.join(self.multiproc_dir, 'retired.lock'), 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                dead = []
+                for filename in os.listdir(self.multiproc_dir):
+                    pid = filename[:-len('.json')]
+                    if not (filename.endswith('.json') and pid.isdigit()):
+                        continue
+                    pid = int(pid)
+                    if include_own if pid == os.getpid() else not self._process_alive(pid):
+                        dead.append(self._snapshot_path(pid))
+                if not dead:
+                    return
+                
+                retired_path = os.path.join(self.multiproc_dir, self.RETIRED_FILENAME)
+                snapshots = self._load_snapshots([retired_path] + dead)
+                self._write_json(retired_path, self._to_snapshot(*self._merge(snapshots)))
+                for path in dead:
+                    os.remove(path)
+        except OSError as e:
+            logger.warning(f"合并已退出进程的指标快照失败: {e}")
+    
+    @staticmethod
+    def _load_snapshots(paths):
+        snapshots = []
+        for path in paths:
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+    
+    @staticmethod
+    def _merge(snapshots):
+        """合并多个快照，返回 (counters, histograms)，相同名称和标签的值相加"""
+        counters = defaultdict(lambda: defaultdict(float))
+        histograms = defaultdict(dict)
+        for snapshot in snapshots:
+            for name, series in snapshot['counters'].items():
+                for labels, value in series:
+                    counters[name][tuple(map(tuple, labels))] += value
+            for name, series in snapshot['histograms'].items():
+                for labels, bucket_counts, total in series:
+                    key = tuple(map(tuple, labels))
+                    state = histograms[name].get(key)
+                    if state is None:
+                        histograms[name][key] = [list(bucket_counts), total]
+                    else:
+                        state[0] = [a + b for a, b in zip(state[0], bucket_counts)]
+                        state[1] += total
+        return counters, histograms
+    
+    @staticmethod
+    def _to_snapshot(counters, histograms):
+        """_merge()结果转回快照格式"""
+        return {
+            'counters': {name: [[list(map(list, key)), value] for key, value in series.items()]
+                         for name, series in counters.items()},
+            'histograms': {name: [[list(map(list, key)), state[0], state[1]] for key, state in series.items()]
+                           for name, series in histograms.items()},
+        }
+    
+    def collect(self):
+        """返回合并后的 (counters, histograms)；多进程时合并所有进程的快照和retired.json"""
+        if not self.multiproc_dir:
+            return self._merge([self.snapshot()])
+        
+        self.dump()
+        return self._merge(self._load_snapshots(
+            os.path.join(self.multiproc_dir, filename)
+            for filename in os.listdir(self.multiproc_dir) if filename.endswith('.json')
+        ))
+    
+    @staticmethod
+    def _format_labels(labels, extra=None):
+        pairs = list(labels) + ([extra] if extra else [])
+        if not pairs:
+            return ''
+        
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in pairs) + '}'
+    
+    @staticmethod
+    def _format_value(value):
+        return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+    
+    def render(self):
+        """Prometheus文本格式（text/plain; version=0.0.4）"""
+        counters, histograms = self.collect()
+        derived = {}
+        for name, func in self._derived:
+            try:
+                derived[name] = func(counters)
+            except Exception as e:
+                logger.warning(f"计算指标失败 {name}: {e}")
+        
+        lines = []
+        for name, (kind, help_text, buckets) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'histogram':
+                for labels, (bucket_counts, total) in sorted(histograms.get(name, {}).items()):
+                    cumulative = 0
+                    for bound, count in zip(buckets + (float('inf'),), bucket_counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f"{name}_bucket{self._format_labels(labels, ('le', le))} {cumulative}")
+                    lines.append(f"{name}_sum{self._format_labels(labels)} {total!r}")
+                    lines.append(f"{name}_count{self._format_labels(labels)} {cumulative}")
+            else:
+                series = counters.get(name, {}) if kind == 'counter' else derived.get(name, {})
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{name}{self._format_labels(labels)} {self._format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics_registry = MetricsRegistry(
+    multiproc_dir=app.config['METRICS_MULTIPROC_DIR'],
+    dump_interval=app.config['METRICS_DUMP_INTERVAL']
+)
+metrics_registry.histogram('http_request_duration_seconds', '请求处理耗时（按方法、路由、状态码）')
+metrics_registry.counter('rate_limit_rejections_total', '被限流拒绝的请求数')
+metrics_registry.histogram('db_query_duration_seconds', 'SQL语句执行耗时（按数据库绑定）',
+                           buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+metrics_registry.counter('cache_hits_total', '缓存命中次数')
+metrics_registry.counter('cache_misses_total', '缓存未命中次数')
+metrics_registry.counter('cache_evictions_total', '缓存因容量淘汰的条目数')
+metrics_registry.counter('rate_limit_redis_round_trips_total', '限流检查的Redis往返次数')
+metrics_registry.derived(
+    'cache_hit_ratio', '缓存命中率',
+    lambda counters: {
+        labels: hits / (hits + counters['cache_misses_total'].get(labels, 0))
+        for labels, hits in counters['cache_hits_total'].items()
+        if hits + counters['cache_misses_total'].get(labels, 0) > 0
+    }
+)
+
+
+@metrics_registry.collector
+def _collect_component_stats():
+    """缓存和限流器自己维护的累计计数"""
+    samples = []
+    for tier, stats in cache_manager.stats().items():
+        samples.append(('cache_hits_total', {'tier': tier}, stats['hits']))
+        samples.append(('cache_misses_total', {'tier': tier}, stats['misses']))
+        if 'evictions' in stats:
+            samples.append(('cache_evictions_total', {'tier': tier}, stats['evictions']))
+    samples.append(('rate_limit_redis_round_trips_total', None, rate_limiter.redis_round_trips))
+    return samples
+
+
+def instrument_engines():
+    """在所有数据库引擎上记录每条SQL的耗时"""
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._query_start = time.perf_counter()
+    
+    def make_after(bind):
+        labels = {'bind': bind}
+        
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            metrics_registry.observe('db_query_duration_seconds',
+                                     time.perf_counter() - context._query_start, labels)
+        return after_cursor_execute
+    
+    with app.app_context():
+        for bind_key, engine in db.engines.items():
+            event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', make_after(bind_key or 'default'))
+
+
+instrument_engines()
+
+
 @app.before_request
 def before_request():
     """请求前处理"""
-    g.start_time = time.time()
+    g.start_time = time.perf_counter()
     
     # 记录请求
     logger.info(f"{request.method} {request.path} from {request.remote_addr}")
@@ -591,8 +3013,17 @@ def after_request(response):
     """请求后处理"""
     # 计算处理时间
     if hasattr(g, 'start_time'):
-        processing_time = time.time() - g.start_time
+        processing_time = time.perf_counter() - g.start_time
         response.headers['X-Processing-Time'] = f"{processing_time:.3f}s"
+        
+        # 未匹配路由统一记为unmatched，避免任意URL产生新的标签值
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics_registry.observe('http_request_duration_seconds', processing_time, {
+            'method': request.method,
+            'route': route,
+            'status': str(response.status_code)
+        })
+        metrics_registry.ensure_dumper()
     
     # 添加CORS头
     response.headers['Access-Control-Allow-Origin'] = '*'
@@ -630,27 +3061,50 @@ def health_check():
         }), 500
 
 
+def database_counts():
+    """
+    一次往返统计用户数和文章数
+    
+    每个计数是一个标量子查询，SQLite可以分别用最小的索引计数
+    （已发布文章数走ix_post_published_created_at_id的范围扫描）。
+    """
+    def count(model, *criteria):
+        return db.select(db.func.count()).select_from(model).where(*criteria).scalar_subquery()
+    
+    row = db.session.execute(db.select(
+        count(User).label('users_total'),
+        count(User, User.is_active == True).label('users_active'),
+        count(Post).label('posts_total'),
+        count(Post, Post.published == True).label('posts_published')
+    )).one()
+    return dict(row._mapping)
+
+
 @app.route('/metrics')
+@read_only
 def metrics():
-    """应用指标"""
+    """应用指标（数据库计数缓存METRICS_CACHE_TTL秒，多个worker同时过期时只有一个回源）"""
     try:
-        user_count = User.query.count()
-        post_count = Post.query.count()
-        active_users = User.query.filter_by(is_active=True).count()
+        counts = cache_manager.get('metrics:database_counts')
+        if counts is None:
+            counts = cache_manager.load('metrics:database_counts', database_counts,
+                                        expire=app.config['METRICS_CACHE_TTL'])
         
         return jsonify({
             'users': {
-                'total': user_count,
-                'active': active_users
+                'total': counts['users_total'],
+                'active': counts['users_active']
             },
             'posts': {
-                'total': post_count,
-                'published': Post.query.filter_by(published=True).count()
+                'total': counts['posts_total'],
+                'published': counts['posts_published']
             },
             'cache': {
                 'type': 'redis' if redis_client else 'memory',
-                'status': 'connected' if redis_client else 'local'
-            }
+                'status': 'connected' if redis_client else 'local',
+                'stats': cache_manager.stats()
+            },
+            'rate_limiter': rate_limiter.stats()
         })
         
     except Exception as e:
@@ -658,12 +3112,27 @@ def metrics():
         return jsonify({'error': '获取指标失败'}), 500
 
 
+@app.route('/metrics/prometheus')
+def prometheus_metrics():
+    """Prometheus抓取端点（多进程时合并所有worker的快照）"""
+    return app.response_class(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
+
 # ====================== 11. 数据库初始化 ======================
 
 def init_db():
     """初始化数据库"""
     with app.app_context():
         db.create_all()
+        # create_all不会给已存在的表补列和索引，正式环境由 flask db migrate 生成迁移
+        user_columns = {column['name'] for column in inspect(db.engine).get_columns('user')}
+        if 'token_version' not in user_columns:
+            db.session.execute(text('ALTER TABLE "user" ADD COLUMN token_version INTEGER NOT NULL DEFAULT 0'))
+            db.session.commit()
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(db.engine, checkfirst=True)
+        post_search.ensure_index()
         
         # 创建管理员用户
         admin = User.query.filter_by(username='admin').first()
@@ -679,7 +3148,314 @@ def init_db():
             print("管理员用户已创建: admin/admin123")
 
 
-# ====================== 12. 运行应用 ======================
+# ====================== 12. 性能基准 ======================
+
+def _sample_post_dicts(count=100, content_size=2000):
+    """生成与Post.to_dict()结构一致的测试数据"""
+    rng = random.Random(42)
+    now = datetime.utcnow().isoformat()
+    words = ['python', 'flask', 'cache', 'redis', 'database', 'interview', 'index', 'query',
+             'thread', 'latency', 'request', 'response', 'server', 'client', 'memory', 'worker',
+             '缓存', '数据库', '并发', '性能', '索引', '查询', '面试', '算法']
+    
+    def text(length):
+        parts = []
+        while sum(len(p) + 1 for p in parts) < length:
+            parts.append(f"{rng.choice(words)}{rng.randint(0, 999)}" if rng.random() < 0.3 else rng.choice(words))
+        return ' '.join(parts)
+    
+    return [{
+        'id': i,
+        'title': text(40),
+        'content': text(content_size),
+        'created_at': now,
+        'updated_at': now,
+        'published': True,
+        'view_count': i * 13,
+        'author': f"user{i % 10}"
+    } for i in range(count)]
+
+
+def benchmark_serializers(post_count=100, rounds=200, compress_threshold=1024):
+    """比较各编解码器在文章列表上的体积和编解码耗时"""
+    payload = {'posts': _sample_post_dicts(post_count), 'pagination': {'page': 1, 'per_page': post_count}}
+    names = [name for name in SERIALIZERS if name != 'msgpack' or msgpack is not None]
+    
+    results = []
+    for name in names:
+        for threshold in (None, compress_threshold):
+            serializer = make_serializer(name, threshold)
+            data = serializer.dumps(payload)
+            
+            start = time.perf_counter()
+            for _ in range(rounds):
+                serializer.dumps(payload)
+            dumps_us = (time.perf_counter() - start) / rounds * 1e6
+            
+            start = time.perf_counter()
+            for _ in range(rounds):
+                serializer.loads(data)
+            loads_us = (time.perf_counter() - start) / rounds * 1e6
+            
+            results.append((serializer.name, len(data), dumps_us, loads_us))
+    
+    print(f"{'编解码器':<16}{'字节数':>10}{'dumps(μs)':>12}{'loads(μs)':>12}")
+    for name, size, dumps_us, loads_us in results:
+        print(f"{name:<16}{size:>10}{dumps_us:>12.1f}{loads_us:>12.1f}")
+    return results
+
+
+def benchmark_rate_limiter(limiter, requests=10000, clients=100, limit=1000, window=60):
+    """测量限流检查的吞吐量、延迟分位数和Redis往返次数"""
+    latencies = []
+    allowed = 0
+    round_trips = limiter.redis_round_trips
+    
+    start = time.perf_counter()
+    for i in range(requests):
+        key = f"bench:{i % clients}"
+        t0 = time.perf_counter()
+        if limiter.is_allowed(key, limit, window):
+            allowed += 1
+        latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - start
+    
+    latencies.sort()
+    result = {
+        'requests': requests,
+        'allowed': allowed,
+        'throughput': requests / elapsed,
+        'p50_us': latencies[len(latencies) // 2] * 1e6,
+        'p99_us': latencies[int(len(latencies) * 0.99)] * 1e6,
+        'redis_round_trips': limiter.redis_round_trips - round_trips
+    }
+    print(f"吞吐量: {result['throughput']:.0f} 次/秒, P50: {result['p50_us']:.1f}μs, "
+          f"P99: {result['p99_us']:.1f}μs, 放行: {allowed}/{requests}, Redis往返: {result['redis_round_trips']}")
+    return result
+
+
+def calibrate_password_hash_cost(target_ms=250, algorithm='scrypt', hash_name='sha256', start_iterations=100000):
+    """
+    按目标耗时选择哈希成本，返回可用于PASSWORD_HASH_METHOD的方法字符串
+    
+    scrypt按2的幂调整N（r=8, p=1，内存约128*N*r字节）；pbkdf2调整迭代次数。
+    """
+    if algorithm == 'scrypt':
+        n = 2 ** 14
+        while True:
+            start = time.perf_counter()
+            generate_password_hash('calibration-password', f"scrypt:{n}:8:1")
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            print(f"scrypt:{n}:8:1 -> {elapsed_ms:.1f}ms")
+            if elapsed_ms >= target_ms:
+                return f"scrypt:{n}:8:1"
+            n *= 2
+    
+    iterations = start_iterations
+    while True:
+        start = time.perf_counter()
+        generate_password_hash('calibration-password', f"pbkdf2:{hash_name}:{iterations}")
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        print(f"pbkdf2:{hash_name}:{iterations} -> {elapsed_ms:.1f}ms")
+        
+        if elapsed_ms >= target_ms:
+            break
+        # 按耗时比例放大，最多翻倍
+        iterations = int(iterations * min(2.0, target_ms / max(elapsed_ms, 1e-3)) + 1)
+    
+    return f"pbkdf2:{hash_name}:{iterations}"
+
+
+def benchmark_sqlite_writes(profile='production', engine_options=None, writers=8, readers=4, duration=5.0):
+    """
+    SQLite并发写入压测（在临时数据库上运行）
+    
+    writers个线程模拟get_post的浏览量提交和login的last_login提交（先读后写），
+    readers个线程同时读取文章列表。返回写入吞吐、延迟分位数和database is locked次数。
+    """
+    if engine_options is None:
+        engine_options = app.config['SQLALCHEMY_POOL_OPTIONS']
+    posts_table, users_table = Post.__table__, User.__table__
+    
+    with tempfile.TemporaryDirectory() as tmpdir:
+        engine = create_engine(f"sqlite:///{os.path.join(tmpdir, 'bench.db')}", **engine_options)
+        pragmas = app.config['SQLITE_PROFILES'][profile]
+        if pragmas:
+            event.listen(engine, 'connect', sqlite_pragma_listener(pragmas))
+        
+        db.metadata.create_all(engine)
+        now = datetime.utcnow()
+        with engine.begin() as conn:
+            conn.execute(users_table.insert(), [{
+                'username': f'bench_{i}', 'email': f'bench_{i}@example.com', 'password_hash': '!',
+                'is_active': True, 'is_admin': False, 'created_at': now, 'token_version': 0
+            } for i in range(1, 101)])
+            conn.execute(posts_table.insert(), [{
+                'title': f'benchmark post {i}', 'content': 'benchmark content', 'created_at': now,
+                'updated_at': now, 'published': True, 'view_count': 0, 'user_id': i % 100 + 1
+            } for i in range(1000)])
+        
+        latencies = []
+        locked = [0]
+        lock = threading.Lock()
+        deadline = time.perf_counter() + duration
+        
+        def write_loop(seed):
+            rng = random.Random(seed)
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    with engine.begin() as conn:
+                        if rng.random() < 0.8:
+                            post_id = rng.randint(1, 1000)
+                            conn.execute(posts_table.select().where(posts_table.c.id == post_id)).first()
+                            conn.execute(posts_table.update().where(posts_table.c.id == post_id)
+                                         .values(view_count=posts_table.c.view_count + 1))
+                        else:
+                            user_id = rng.randint(1, 100)
+                            conn.execute(users_table.select().where(users_table.c.id == user_id)).first()
+                            conn.execute(users_table.update().where(users_table.c.id == user_id)
+                                         .values(last_login=datetime.utcnow()))
+                    elapsed = time.perf_counter() - start
+                    with lock:
+                        latencies.append(elapsed)
+                except OperationalError:
+                    with lock:
+                        locked[0] += 1
+        
+        def read_loop():
+            query = posts_table.select().where(posts_table.c.published == True) \
+                .order_by(posts_table.c.created_at.desc()).limit(20)
+            while time.perf_counter() < deadline:
+                with engine.connect() as conn:
+                    conn.execute(query).all()
+        
+        threads = [threading.Thread(target=write_loop, args=(i,)) for i in range(writers)]
+        threads += [threading.Thread(target=read_loop) for _ in range(readers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        engine.dispose()
+    
+    latencies.sort()
+    result = {
+        'profile': profile,
+        'writes': len(latencies),
+        'throughput': len(latencies) / duration,
+        'p50_ms': latencies[len(latencies) // 2] * 1000 if latencies else None,
+        'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000 if latencies else None,
+        'locked_errors': locked[0]
+    }
+    print(f"[{profile}] 写入: {result['writes']}, 吞吐量: {result['throughput']:.0f} 次/秒, "
+          f"P50: {result['p50_ms'] or 0:.1f}ms, P99: {result['p99_ms'] or 0:.1f}ms, locked: {locked[0]}")
+    return result
+
+
+def seed_benchmark_data(posts=1000000, users=1000, batch_size=10000):
+    """批量写入测试用户和文章（Core批量INSERT，需要应用上下文），完成后执行ANALYZE"""
+    rng = random.Random(42)
+    start = time.perf_counter()
+    base = datetime.utcnow() - timedelta(days=365)
+    first_user_id = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+    
+    db.session.execute(User.__table__.insert(), [{
+        'username': f'bench_{first_user_id + i}',
+        'email': f'bench_{first_user_id + i}@example.com',
+        'password_hash': '!',
+        'is_active': True,
+        'is_admin': False,
+        'created_at': base + timedelta(seconds=rng.randint(0, 365 * 86400)),
+        'token_version': 0
+    } for i in range(users)])
+    
+    for offset in range(0, posts, batch_size):
+        rows = []
+        for i in range(offset, min(offset + batch_size, posts)):
+            created_at = base + timedelta(seconds=rng.randint(0, 365 * 86400))
+            rows.append({
+                'title': f'benchmark post {i}',
+                'content': 'benchmark content',
+                'created_at': created_at,
+                'updated_at': created_at,
+                'published': rng.random() < 0.9,
+                'view_count': 0,
+                'user_id': first_user_id + rng.randrange(users)
+            })
+        db.session.execute(Post.__table__.insert(), rows)
+        db.session.commit()
+    
+    db.session.execute(text('ANALYZE'))
+    db.session.commit()
+    print(f"写入 {users} 个用户、{posts} 篇文章，耗时 {time.perf_counter() - start:.1f}s")
+
+
+def _hot_queries():
+    """列表和后台接口实际执行的查询（与路由中的写法保持一致）"""
+    cursor = (datetime.utcnow() - timedelta(days=180), 0)
+    posts = Post.query.options(db.joinedload(Post.author)).filter_by(published=True)
+    
+    return {
+        'posts_first_page': posts.order_by(Post.created_at.desc(), Post.id.desc()).limit(11),
+        'posts_keyset_page': posts.filter(tuple_(Post.created_at, Post.id) < cursor)
+                                  .order_by(Post.created_at.desc(), Post.id.desc()).limit(11),
+        'posts_offset_page': posts.order_by(Post.created_at.desc()).limit(10).offset(10000),
+        'user_posts': Post.query.filter_by(user_id=1).order_by(Post.created_at.desc()).limit(10),
+        'admin_users_first_page': User.query.order_by(User.created_at.desc(), User.id.desc()).limit(21),
+        'admin_users_keyset_page': User.query.filter(tuple_(User.created_at, User.id) < cursor)
+                                       .order_by(User.created_at.desc(), User.id.desc()).limit(21),
+    }
+
+
+def explain_hot_queries():
+    """对热点查询执行EXPLAIN QUERY PLAN，返回 {名称: [计划行]}（仅SQLite）"""
+    plans = {}
+    for name, query in _hot_queries().items():
+        dialect = db.engine.dialect
+        compiled = query.statement.compile(dialect=dialect)
+        params = compiled.construct_params()
+        values = []
+        for key in compiled.positiontup:
+            processor = compiled.binds[key].type.bind_processor(dialect)
+            values.append(processor(params[key]) if processor else params[key])
+        
+        rows = db.session.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", tuple(values))
+        plans[name] = [row[-1] for row in rows]
+    return plans
+
+
+def assert_hot_queries_use_indexes():
+    """热点查询不允许全表扫描post/user表，也不允许为ORDER BY建临时B树"""
+    plans = explain_hot_queries()
+    problems = []
+    for name, plan in plans.items():
+        for detail in plan:
+            full_scan = re.match(r'SCAN (post|user)\b', detail) and 'USING' not in detail
+            if full_scan or 'USE TEMP B-TREE FOR ORDER BY' in detail:
+                problems.append(f"{name}: {detail}")
+    
+    if problems:
+        raise AssertionError("热点查询未使用索引:\n" + "\n".join(problems))
+    return plans
+
+
+@app.cli.command('explain-queries')
+@click.option('--seed', default=0, help='先写入指定数量的测试文章')
+def explain_queries_command(seed):
+    """打印热点查询的执行计划，并检查是否都走索引"""
+    init_db()
+    with app.app_context():
+        if seed:
+            seed_benchmark_data(posts=seed)
+        for name, plan in explain_hot_queries().items():
+            print(name)
+            for detail in plan:
+                print(f"    {detail}")
+        assert_hot_queries_use_indexes()
+        print("所有热点查询均使用索引")
+
+
+# ====================== 13. 运行应用 ======================
 
 if __name__ == '__main__':
     init_db()
@@ -0,0 +1,530 @@
+"""
+enterprise_flask_app 查询数回归测试
+
+运行: pytest practice_projects/test_enterprise_flask_app.py
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+# 必须在导入应用之前设置，使用临时数据库而不是开发库
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db')
+
+import pytest
+
+import enterprise_flask_app as app_module
+from enterprise_flask_app import app, db, User, Post, QueryCounter
+
+
+@pytest.fixture(scope='module')
+def client():
+    app_module.init_db()
+    return app.test_client()
+
+
+def seed_posts(count):
+    """每篇文章使用不同的作者，逐条加载author时查询数会随count增长"""
+    with app.app_context():
+        for i in range(count):
+            suffix = uuid.uuid4().hex[:12]
+            author = User(username=f'author_{suffix}', email=f'{suffix}@example.com', password_hash='!')
+            db.session.add(author)
+            db.session.flush()
+            db.session.add(Post(title=f'post {i}', content='content', published=True, user_id=author.id))
+        db.session.commit()
+
+
+@pytest.mark.parametrize('count', [5, 30])
+def test_post_list_query_count_does_not_grow_with_page_size(client, count):
+    seed_posts(count)
+
+    with app.app_context(), QueryCounter(max_queries=2) as counter:
+        # 唯一参数绕过响应缓存，保证真正执行查询
+        response = client.get(f'/api/posts?per_page={count}&nocache={uuid.uuid4().hex}')
+
+    assert response.status_code == 200
+    assert len(response.get_json()['posts']) == count
+    assert counter.count >= 1
+
+
+def test_query_counter_reports_statements_over_limit(client):
+    with app.app_context():
+        with pytest.raises(AssertionError, match='超过上限0'):
+            with QueryCounter(max_queries=0):
+                User.query.count()
+
+
+@pytest.mark.parametrize('method, stored, expected', [
+    (None, 'pbkdf2:sha256:1000', False),
+    ('pbkdf2', 'scrypt', False),
+    ('pbkdf2', 'pbkdf2:sha256:1000', True),
+    ('pbkdf2', 'pbkdf2', False),
+    ('scrypt', 'pbkdf2', True),
+    ('scrypt', 'scrypt', False),
+    ('scrypt:65536', 'scrypt', True),
+    ('scrypt:16384', 'scrypt', False),
+])
+def test_password_rehash_only_upgrades(method, stored, expected):
+    hasher = app_module.PasswordHasher(method)
+    assert hasher.needs_rehash(app_module.generate_password_hash('pw', stored)) is expected
+
+
+def test_login_keeps_default_scrypt_hash(client):
+    with app.app_context():
+        user = User(username='scrypt_user', email='scrypt@example.com',
+                    password_hash=app_module.generate_password_hash('pw', 'scrypt'))
+        db.session.add(user)
+        db.session.commit()
+        before = user.password_hash
+
+    assert client.post('/api/login', json={'username': 'scrypt_user', 'password': 'pw'}).status_code == 200
+    with app.app_context():
+        assert User.query.filter_by(username='scrypt_user').first().password_hash == before
+
+
+def test_missing_msgpack_falls_back_to_json(monkeypatch):
+    monkeypatch.setattr(app_module, 'msgpack', None)
+    assert app_module.make_serializer('msgpack').name == 'json'
+
+
+def test_cache_lock_waiter_takes_over_when_holder_releases_without_value():
+    fakeredis = pytest.importorskip('fakeredis')
+    server = fakeredis.FakeServer()
+    holder = app_module.CacheManager(fakeredis.FakeRedis(server=server))
+    waiter = app_module.CacheManager(fakeredis.FakeRedis(server=server))
+
+    # 持锁者回源失败（例如结果不可缓存），释放锁但没有写入缓存
+    token = holder.acquire_lock('k')
+    threading.Timer(0.1, holder.release_lock, args=('k', token)).start()
+
+    start = time.monotonic()
+    assert waiter.load('k', lambda: 'value', expire=60) == 'value'
+    assert time.monotonic() - start < 1
+
+
+def seed_titles(titles):
+    with app.app_context():
+        suffix = uuid.uuid4().hex[:12]
+        author = User(username=f'writer_{suffix}', email=f'{suffix}@example.org', password_hash='!')
+        db.session.add(author)
+        db.session.flush()
+        for title in titles:
+            db.session.add(Post(title=title, content='正文', published=True, user_id=author.id))
+        db.session.commit()
+
+
+def search_titles(client, search):
+    response = client.get('/api/posts', query_string={'search': search, 'per_page': 100,
+                                                       'nocache': uuid.uuid4().hex})
+    assert response.status_code == 200
+    return [post['title'] for post in response.get_json()['posts']]
+
+
+def test_search_matches_chinese_substrings(client):
+    seed_titles([f'缓存系统设计 {i}' for i in range(5)])
+
+    # 两个字的词短于trigram，回退到LIKE；三个字及以上走FTS索引
+    assert len([t for t in search_titles(client, '系统') if t.startswith('缓存系统设计')]) == 5
+    assert len(search_titles(client, '系统设')) == 5
+    assert search_titles(client, '不存在的标题') == []
+
+
+def test_search_index_migrates_old_unicode61_table(client):
+    with app.app_context():
+        db.session.execute(app_module.text('DROP TABLE post_fts'))
+        db.session.execute(app_module.text(app_module.PostSearch.TABLE.format(tokenizer='unicode61')))
+        db.session.commit()
+        app_module.post_search.ensure_index()
+        assert app_module.post_search._current_tokenizer() == 'trigram'
+
+    seed_titles(['Distributed tracing primer'])
+    assert search_titles(client, 'tracing') == ['Distributed tracing primer']
+    assert search_titles(client, 'ibuted trac') == ['Distributed tracing primer']
+
+
+@pytest.mark.parametrize('uri, pooled', [
+    ('sqlite://', False),
+    ('sqlite:///:memory:', False),
+    ('sqlite:///file:test?mode=memory&uri=true', False),
+    ('sqlite:///enterprise_app.db', True),
+    ('postgresql://user@localhost/app', True),
+])
+def test_engine_options_skip_pool_sizing_for_in_memory_sqlite(uri, pooled):
+    options = app_module.engine_options_for(uri, {'pool_size': 10})
+    assert ('pool_size' in options) is pooled
+
+
+def test_app_imports_with_in_memory_database():
+    env = dict(os.environ, DATABASE_URL='sqlite://')
+    result = subprocess.run(
+        [sys.executable, '-c', 'import enterprise_flask_app as m; m.init_db()'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env, capture_output=True, text=True
+    )
+    assert result.returncode == 0, result.stderr
+
+
+@pytest.fixture(params=[False, True], ids=['snapshot', 'claims'])
+def claims_mode(request, monkeypatch):
+    monkeypatch.setitem(app.config, 'JWT_CLAIMS_MODE', request.param)
+    return request.param
+
+
+def create_user(is_admin=False):
+    """创建用户并返回(user_id, 认证头)"""
+    with app.app_context():
+        suffix = uuid.uuid4().hex[:12]
+        user = User(username=f'member_{suffix}', email=f'{suffix}@example.net', password_hash='!',
+                    is_admin=is_admin)
+        db.session.add(user)
+        db.session.commit()
+        return user.id, {'Authorization': f'Bearer {user.generate_token()}'}
+
+
+def update_user(user_id, **fields):
+    with app.app_context():
+        user = db.session.get(User, user_id)
+        for name, value in fields.items():
+            setattr(user, name, value)
+        db.session.commit()
+
+
+def test_deactivated_user_is_rejected_immediately(client, claims_mode):
+    user_id, headers = create_user()
+    assert client.get('/api/profile', headers=headers).status_code == 200  # 预热认证缓存
+
+    update_user(user_id, is_active=False)
+    assert client.get('/api/profile', headers=headers).status_code == 401
+
+
+def test_demoted_admin_loses_access_immediately(client, claims_mode):
+    user_id, headers = create_user(is_admin=True)
+    assert client.get('/api/admin/users', headers=headers).status_code == 200
+
+    update_user(user_id, is_admin=False)
+    # 快照模式下用户快照失效后按普通用户处理；声明模式下旧令牌版本被吊销
+    assert client.get('/api/admin/users', headers=headers).status_code == (401 if claims_mode else 403)
+
+
+def test_deleted_user_token_is_rejected(client, claims_mode):
+    user_id, headers = create_user()
+    assert client.get('/api/profile', headers=headers).status_code == 200
+
+    with app.app_context():
+        db.session.delete(db.session.get(User, user_id))
+        db.session.commit()
+    assert client.get('/api/profile', headers=headers).status_code in (401, 404)
+
+
+def test_rolled_back_change_revokes_nothing(client, claims_mode):
+    user_id, headers = create_user(is_admin=True)
+    assert client.get('/api/admin/users', headers=headers).status_code == 200
+
+    with app.app_context():
+        user = db.session.get(User, user_id)
+        user.is_admin = False
+        user.is_active = False
+        db.session.flush()
+        db.session.rollback()
+        assert 'principal_changes' not in db.session.info
+
+    assert client.get('/api/admin/users', headers=headers).status_code == 200
+    assert not app_module.token_denylist.is_revoked(user_id, 0)
+
+
+def test_principal_loaded_between_flush_and_commit_is_not_kept():
+    user_id, headers = create_user(is_admin=True)
+    token = headers['Authorization'].replace('Bearer ', '')
+    seen = []
+
+    def load_in_other_request():
+        with app.app_context():
+            seen.append(app_module.load_principal(token).is_admin)
+
+    with app.app_context():
+        app_module.load_principal(token)
+        user = db.session.get(User, user_id)
+        user.is_admin = False
+        db.session.flush()
+        # 另一个请求在提交前读到旧的已提交行并写入缓存
+        worker = threading.Thread(target=load_in_other_request)
+        worker.start()
+        worker.join()
+        db.session.commit()
+
+    with app.app_context():
+        assert seen == [True]
+        assert app_module.load_principal(token).is_admin is False
+
+
+def redis_limiters(count=1, **kwargs):
+    """共享同一个fakeredis服务器的多个限流器，模拟多个worker"""
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')  # fakeredis执行Lua脚本需要lupa
+    server = fakeredis.FakeServer()
+    return [app_module.RateLimiter(fakeredis.FakeRedis(server=server), **kwargs) for _ in range(count)]
+
+
+@pytest.mark.parametrize('algorithm', app_module.RateLimiter.ALGORITHMS)
+def test_redis_and_memory_limiters_agree(algorithm):
+    redis_limiter, = redis_limiters(algorithm=algorithm)
+    memory_limiter = app_module.RateLimiter(algorithm=algorithm)
+    checks = [('ip', 3, 30), ('user', 5, 60)]
+
+    # 突发、被拒、部分恢复、完全恢复；窗口取几十秒，避免fakeredis按真实时间让键过期
+    start = 1_000_000.0
+    for offset in [0, 0.5, 1, 1.5, 2, 9, 10.25, 11, 25, 31, 45, 70, 71, 200]:
+        now = start + offset
+        expected = memory_limiter._memory_check(checks, now)
+        actual = redis_limiter._redis_check(checks, now)
+        for want, got in zip(expected, actual):
+            assert got.allowed == want.allowed, (offset, got, want)
+            assert got.remaining == want.remaining, (offset, got, want)
+            # Lua脚本按毫秒向上取整返回时间
+            assert got.reset_after == pytest.approx(want.reset_after, abs=1e-3), (offset, got, want)
+            assert got.retry_after == pytest.approx(want.retry_after, abs=1e-3), (offset, got, want)
+
+
+@pytest.mark.parametrize('backend', ['memory', 'redis'])
+@pytest.mark.parametrize('algorithm', app_module.RateLimiter.ALGORITHMS)
+def test_is_allowed_many_records_nothing_when_any_key_denies(backend, algorithm):
+    if backend == 'redis':
+        limiter, = redis_limiters(algorithm=algorithm)
+    else:
+        limiter = app_module.RateLimiter(algorithm=algorithm)
+
+    assert limiter.is_allowed('ip', 1, 60)
+    results = limiter.is_allowed_many([('ip', 1, 60), ('user', 2, 60)])
+    assert [r.allowed for r in results] == [False, True]
+    assert not app_module.RateLimitResult.combine(results)
+
+    # 被拒绝的组合请求没有消耗user的配额
+    assert limiter.is_allowed('user', 2, 60).remaining == 1
+
+
+@pytest.mark.parametrize('workers, limit, sync_fraction', [(1, 100, 0.1), (4, 100, 0.1), (4, 50, 0.2)])
+def test_approximate_limiter_overshoot_is_bounded(workers, limit, sync_fraction):
+    limiters = redis_limiters(workers, sync_fraction=sync_fraction)
+    now = 1_000_000.0 + 1  # 固定在同一个计数窗口内
+    checks = [('client', limit, 60)]
+
+    allowed = 0
+    for i in range(limit * 3):
+        if limiters[i % workers]._approximate_check(checks, now)[0]:
+            allowed += 1
+
+    assert limit <= allowed <= limit + workers * int(limit * sync_fraction)
+
+
+REPLICA_SCRIPT = '''
+import json, sqlite3, sys
+import enterprise_flask_app as m
+
+primary_path, replica_path = sys.argv[1:3]
+m.init_db()
+with m.app.app_context():
+    tokens = {}
+    for name in ('writer', 'reader'):
+        user = m.User(username=name, email=name + '@example.com', password_hash='!')
+        m.db.session.add(user)
+        m.db.session.flush()
+        m.db.session.add(m.Post(title=name + ' post', content='c', published=True, user_id=user.id))
+        m.db.session.commit()
+        tokens[name] = {'Authorization': 'Bearer ' + user.generate_token()}
+
+# 副本是主库此刻的快照，之后的写入只进主库
+source, target = sqlite3.connect(primary_path), sqlite3.connect(replica_path)
+source.backup(target)
+source.close(), target.close()
+
+client = m.app.test_client()
+assert client.post('/api/posts', json={'title': 'fresh', 'content': 'c', 'published': True},
+                   headers=tokens['writer']).status_code == 201
+
+def titles(headers=None):
+    return sorted(p['title'] for p in client.get('/api/posts', headers=headers).get_json()['posts'])
+
+print(json.dumps({
+    'reader': titles(tokens['reader']),
+    'anonymous': titles(),
+    'writer': titles(tokens['writer']),
+}))
+'''
+
+
+def test_reads_go_to_replica_except_for_the_recent_writer(tmp_path):
+    primary, replica = tmp_path / 'primary.db', tmp_path / 'replica.db'
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{primary}', REPLICA_DATABASE_URL=f'sqlite:///{replica}')
+    result = subprocess.run(
+        [sys.executable, '-c', REPLICA_SCRIPT, str(primary), str(replica)],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env, capture_output=True, text=True
+    )
+    assert result.returncode == 0, result.stderr
+    seen = json.loads(result.stdout.strip().splitlines()[-1])
+
+    stale = ['reader post', 'writer post']
+    assert seen['reader'] == stale
+    assert seen['anonymous'] == stale  # 命中上面从副本缓存的列表页
+    # 写入者绕过响应缓存并读主库，能看到自己刚发的文章
+    assert seen['writer'] == ['fresh', 'reader post', 'writer post']
+
+
+@pytest.fixture
+def author_posts(client):
+    """7篇文章，其中几篇created_at相同，按(created_at, id)倒序返回(author_id, 期望顺序)"""
+    base = datetime(2024, 1, 1)
+    with app.app_context():
+        suffix = uuid.uuid4().hex[:12]
+        author = User(username=f'pager_{suffix}', email=f'{suffix}@example.io', password_hash='!')
+        db.session.add(author)
+        db.session.flush()
+        for minutes in [0, 1, 1, 1, 2, 3, 3]:
+            db.session.add(Post(title='p', content='c', published=True, user_id=author.id,
+                                created_at=base + timedelta(minutes=minutes)))
+        db.session.commit()
+        ordered = Post.query.filter_by(user_id=author.id).order_by(Post.created_at.desc(), Post.id.desc())
+        return author.id, [post.id for post in ordered]
+
+
+def paginate(author_id, per_page=3, **cursors):
+    with app.app_context():
+        rows, pagination = app_module.keyset_paginate(
+            Post.query.filter_by(user_id=author_id), Post, per_page, **cursors
+        )
+        return [row.id for row in rows], pagination
+
+
+def test_keyset_paginate_walks_forward_and_back(author_posts):
+    author_id, expected = author_posts
+
+    first, first_page = paginate(author_id)
+    second, second_page = paginate(author_id, after=first_page['next_cursor'])
+    last, last_page = paginate(author_id, after=second_page['next_cursor'])
+    assert first + second + last == expected
+    assert (first_page['has_more'], first_page['prev_cursor']) == (True, None)
+    assert (last_page['has_more'], last_page['next_cursor']) == (False, None)
+    assert last_page['prev_cursor'] is not None
+
+    # 向前翻页回到同样的页，第一页没有prev_cursor
+    back, back_page = paginate(author_id, before=last_page['prev_cursor'])
+    assert back == second and back_page['has_more'] and back_page['prev_cursor']
+    front, front_page = paginate(author_id, before=back_page['prev_cursor'])
+    assert front == first
+    assert front_page['prev_cursor'] is None
+    assert front_page['next_cursor'] == first_page['next_cursor']
+
+
+def test_keyset_paginate_exact_multiple_has_no_extra_page(author_posts):
+    author_id, expected = author_posts
+
+    rows, pagination = paginate(author_id, per_page=len(expected))
+    assert rows == expected
+    assert (pagination['has_more'], pagination['next_cursor'], pagination['prev_cursor']) == (False, None, None)
+
+
+def test_cursor_round_trip():
+    created_at = datetime(2024, 5, 6, 7, 8, 9, 123456)
+    assert app_module.decode_cursor(app_module.encode_cursor(created_at, 42)) == (created_at, 42)
+
+
+MALFORMED_CURSORS = [
+    'not a cursor!',
+    app_module._encode_token('x'),
+    app_module._encode_token(None),
+    app_module._encode_token([1]),
+    app_module._encode_token(['not a date', 1]),
+    app_module._encode_token(['2024-01-01T00:00:00', 'id']),
+]
+
+
+@pytest.mark.parametrize('cursor', MALFORMED_CURSORS)
+def test_decode_cursor_rejects_malformed(cursor):
+    with pytest.raises(app_module.InvalidCursorError):
+        app_module.decode_cursor(cursor)
+
+
+@pytest.mark.parametrize('param', ['after', 'before'])
+@pytest.mark.parametrize('cursor', MALFORMED_CURSORS)
+def test_post_list_returns_400_for_malformed_cursor(client, param, cursor):
+    assert client.get('/api/posts', query_string={param: cursor}).status_code == 400
+
+
+@pytest.mark.parametrize('cursor', ['not a cursor!', app_module._encode_token({'offset': -1}),
+                                    app_module._encode_token([0])])
+def test_search_returns_400_for_malformed_cursor(client, cursor):
+    response = client.get('/api/posts', query_string={'search': 'tracing', 'after': cursor})
+    assert response.status_code == 400
+
+
+def test_local_cache_size_estimate_tracks_serialized_size():
+    posts = app_module._sample_post_dicts(100)
+    entry = {'body': json.dumps(posts).encode(), 'status': 200, 'headers': [('Content-Type', 'application/json')]}
+
+    for value, serialized in [(posts, len(json.dumps(posts))), (entry, len(entry['body']))]:
+        assert serialized / 2 < app_module.LocalCache._estimate_size(value) < serialized * 2
+
+
+def metrics_registry(directory, dump_interval=5):
+    registry = app_module.MetricsRegistry(multiproc_dir=str(directory), dump_interval=dump_interval)
+    registry.counter('jobs_total', 'jobs')
+    return registry
+
+
+def write_snapshot(directory, pid, value):
+    snapshot = {'counters': {'jobs_total': [[[], value]]}, 'histograms': {}}
+    (directory / f'{pid}.json').write_text(json.dumps(snapshot))
+
+
+def exited_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def jobs_total(registry):
+    counters, _ = registry.collect()
+    return counters['jobs_total'][()]
+
+
+def test_metrics_snapshots_are_written_in_background(tmp_path):
+    registry = metrics_registry(tmp_path, dump_interval=0.05)
+    registry.inc('jobs_total')
+
+    registry.ensure_dumper()
+    assert not (tmp_path / f'{os.getpid()}.json').exists()  # 请求中不同步写文件
+    deadline = time.monotonic() + 2
+    while not (tmp_path / f'{os.getpid()}.json').exists() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert (tmp_path / f'{os.getpid()}.json').exists()
+
+
+def test_exited_worker_snapshots_are_merged_into_retired_totals(tmp_path):
+    registry = metrics_registry(tmp_path)
+    registry.inc('jobs_total', value=1)
+    for value in (2, 3):
+        write_snapshot(tmp_path, exited_pid(), value)
+
+    registry._retire_snapshots()
+    assert sorted(p.name for p in tmp_path.glob('*.json')) == ['retired.json']
+    assert jobs_total(registry) == 6
+
+    # 再退出一个worker时累加到同一个文件
+    write_snapshot(tmp_path, exited_pid(), 4)
+    registry._retire_snapshots()
+    assert sorted(p.name for p in tmp_path.glob('*.json')) == [f'{os.getpid()}.json', 'retired.json']
+    assert jobs_total(registry) == 10
+
+
+def test_reused_pid_snapshot_is_retired_before_overwrite(tmp_path):
+    write_snapshot(tmp_path, os.getpid(), 5)  # 同pid的旧进程留下的快照
+    registry = metrics_registry(tmp_path)
+    registry.inc('jobs_total', value=1)
+
+    assert jobs_total(registry) == 6
+    assert jobs_total(registry) == 6  # 之后的抓取不会重复合并